@@ -1,179 +1,162 @@
-import RPi.GPIO as GPIO
+import config as config
+import gpio
+import metrics
+
+# Relay state for each cooling mode, keyed by the relay names in
+# config.GPIO_PINS. True means the device is on, or for the damper, open.
+# Adding a mode only needs a new entry here.
+MODES = {
+    # Open damper, both fans and AC off
+    'passive':           {'damper': True,  'fan_1': False, 'fan_2': False, 'ac_unit': False},
+    # Open damper, fan 1 on, fan 2 and AC off
+    'freecooling':       {'damper': True,  'fan_1': True,  'fan_2': False, 'ac_unit': False},
+    # Open damper, both fans on, AC off
+    'freecooling_turbo': {'damper': True,  'fan_1': True,  'fan_2': True,  'ac_unit': False},
+    # Closed damper, both fans off, AC on
+    'ac':                {'damper': False, 'fan_1': False, 'fan_2': False, 'ac_unit': True},
+    # Something has gone wrong, like the AC failing: try everything to cool down
+    'emergency':         {'damper': True,  'fan_1': True,  'fan_2': True,  'ac_unit': True},
+}
+
+# Relays that switch their device on when the pin is LOW. The AC is wired this
+# way so that it runs by default (power absent), protecting the room if the
+# controller fails.
+ACTIVE_LOW = {'ac_unit'}
+
+class RelayBank:
+    """
+    Idempotent output stage for the relay pins.
+
+    Keeps a shadow register of the level each pin was last driven to and,
+    when asked to apply a set of levels, writes only the pins that differ in a
+    single batched GPIO call. Re-applying the current mode every evaluation
+    therefore costs no GPIO writes and cannot glitch the relays.
+
+    Every level change is counted per relay so relay wear can be estimated.
 
-# Disable GPIO warnings
-GPIO.setwarnings(False)
-
-# Use Broadcom SOC channel numbers
-GPIO.setmode(GPIO.BCM)
-
-# Define GPIO pins
-FAN_1_PIN = 22
-FAN_2_PIN = 26
-AC_PIN = 6
-DAMPER_PIN = 4
-
-# Pin setup
-GPIO.setup(FAN_1_PIN, GPIO.OUT)   # Corresponds to WiringPi pin 3
-GPIO.setup(FAN_2_PIN, GPIO.OUT)   # Corresponds to WiringPi pin 25
-GPIO.setup(AC_PIN, GPIO.OUT)       # Corresponds to WiringPi pin 22
-GPIO.setup(DAMPER_PIN, GPIO.OUT)   # Corresponds to WiringPi pin 7
-
-def cleanup_gpio():
-    """Cleans up all the GPIO settings by resetting the GPIO pins."""
-    GPIO.cleanup()
-
-def turn_on_fan_1():
-    """Turns on fan 1 by setting its GPIO pin to HIGH."""
-    GPIO.output(FAN_1_PIN, GPIO.HIGH)
-
-def turn_off_fan_1():
-    """Turns off fan 1 by setting its GPIO pin to LOW."""
-    GPIO.output(FAN_1_PIN, GPIO.LOW)
-
-def turn_on_fan_2():
-    """Turns on fan 2 by setting its GPIO pin to HIGH."""
-    GPIO.output(FAN_2_PIN, GPIO.HIGH)
-
-def turn_off_fan_2():
-    """Turns off fan 2 by setting its GPIO pin to LOW."""
-    GPIO.output(FAN_2_PIN, GPIO.LOW)
-
-def turn_on_ac():
-    """Turns on the AC unit by setting its GPIO pin to LOW."""
-    GPIO.output(AC_PIN, GPIO.LOW)
-
-def turn_off_ac():
-    """Turns off the AC unit by setting its GPIO pin to HIGH."""
-    GPIO.output(AC_PIN, GPIO.HIGH)
-
-def open_damper():
-    """Opens the damper by setting its GPIO pin to HIGH."""
-    GPIO.output(DAMPER_PIN, GPIO.HIGH)
-
-def close_damper():
-    """Closes the damper by setting its GPIO pin to LOW."""
-    GPIO.output(DAMPER_PIN, GPIO.LOW)
-
-def ac_on(temperature_value):
-    """
-    Activates the AC unit and prepares for cooling.
-
-    Closes the damper, turns off both fans, and turns on the AC unit.
-    
     Parameters:
-    - temperature_value (float): The current temperature reading (not used in this function).
-    """
-    close_damper()
-    turn_off_fan_1()
-    turn_off_fan_2()
-    turn_on_ac()
-
-def freecooling(temperature_value):
-    """
-    Activates free cooling mode.
-
-    Opens the damper, turns on fan 1, turns off fan 2, and turns off the AC unit.
+    - backend (object): GPIO backend used to drive the pins, see gpio.py.
+    - pins (dict): Mapping of relay names to GPIO pin numbers.
+    - zone (str): Name of the zone the relays cool, for metrics.
+    """
+
+    def __init__(self, backend, pins, zone='default'):
+        self.backend = backend
+        self.pins = dict(pins)
+        self.zone = zone
+        self.levels = {name: None for name in self.pins}  # None until the pin is first written
+        self.actuations = {name: 0 for name in self.pins}
+
+        for pin in self.pins.values():
+            self.backend.setup_output(pin)
+
+    def apply(self, levels):
+        """
+        Drives relays to the given pin levels, writing only those that change.
+
+        Parameters:
+        - levels (dict): Mapping of relay names to gpio.HIGH or gpio.LOW.
+
+        Returns:
+        - list: The names of the relays that were written.
+        """
+        changed = [name for name, level in levels.items() if self.levels[name] != level]
+        if not changed:
+            return changed
+
+        self.backend.write([self.pins[name] for name in changed], [levels[name] for name in changed])
+        for name in changed:
+            # The first write after startup sets a known state rather than switching a relay
+            if self.levels[name] is not None:
+                self.actuations[name] += 1
+                metrics.RELAY_ACTUATIONS.labels(self.zone, name).inc()
+            self.levels[name] = levels[name]
+        return changed
+
+    def read(self):
+        """Returns the level each relay pin currently reads back as."""
+        return {name: self.backend.read(pin) for name, pin in self.pins.items()}
+
+    def invalidate(self):
+        """Forgets the shadow register so the next apply() rewrites every pin it is given."""
+        self.levels = {name: None for name in self.levels}
+
+def to_level(relay, on):
+    """Converts a relay's logical on/off state into the pin level that produces it."""
+    if relay in ACTIVE_LOW:
+        on = not on
+    return gpio.HIGH if on else gpio.LOW
+
+def from_level(relay, level):
+    """Converts a pin level read back from a relay into its logical on/off state."""
+    on = level == gpio.HIGH
+    return not on if relay in ACTIVE_LOW else on
+
+# GPIO backend shared by every zone's relays
+backend = gpio.create_backend(config.GPIO_BACKEND)
+
+# Relays in config.GPIO_PINS, for the single zone used when ZONES is empty. With
+# ZONES set each zone has its own bank and GPIO_PINS is never set up, so a pin
+# it names cannot be driven behind another zone's back.
+relays = None if config.ZONES else RelayBank(backend, config.GPIO_PINS)
+
+def set_mode(mode, bank=None):
+    """
+    Drives the relays into a cooling mode.
 
     Parameters:
-    - temperature_value (float): The current temperature reading (not used in this function).
-    """
-    open_damper()
-    turn_on_fan_1()
-    turn_off_fan_2()
-    turn_off_ac()
-
-def freecooling_turbo(temperature_value):
-    """
-    Activates turbo free cooling mode.
+    - mode (str): A key of MODES.
+    - bank (RelayBank): The zone's relays, defaults to the relays in config.GPIO_PINS.
 
-    Opens the damper, turns on both fans, and turns off the AC unit.
+    Returns:
+    - list: The names of the relays that changed state.
 
-    Parameters:
-    - temperature_value (float): The current temperature reading (not used in this function).
+    Raises:
+    - KeyError: If the mode is unknown.
     """
-    open_damper()
-    turn_on_fan_1()
-    turn_on_fan_2()
-    turn_off_ac()
+    return (bank or relays).apply({relay: to_level(relay, on) for relay, on in MODES[mode].items()})
 
-def passive_cooling(temperature_value):
+def set_relay(relay, on):
     """
-    Activates passive cooling mode.
+    Switches a single relay on or off, outside of any mode.
 
-    Opens the damper, turns off both fans, and turns off the AC unit.
+    Only the relays in config.GPIO_PINS can be switched, so ZONES must be empty.
 
     Parameters:
-    - temperature_value (float): The current temperature reading (not used in this function).
-    """
-    open_damper()
-    turn_off_fan_1()
-    turn_off_fan_2()
-    turn_off_ac()
-
-def emergency(temperature_value):
+    - relay (str): A key of config.GPIO_PINS.
+    - on (bool): True to switch the device on, or open the damper.
     """
-    Emergency Mode, something has gone wrong.
-    Something like the AC has failed try everything to cool down.
+    relays.apply({relay: to_level(relay, on)})
 
-    Opens the damper, turns on both fans, and turns on the AC unit.
+def read_relays(bank=None):
     """
-    open_damper()
-    turn_on_fan_1()
-    turn_on_fan_2()
-    turn_on_ac()
+    Reads the relay pins back from the hardware.
 
-def ac_on_web():
-    """
-    Activates the AC unit for web control.
-
-    Closes the damper, turns off both fans, and turns on the AC unit.
-    """
-    close_damper()
-    turn_off_fan_1()
-    turn_off_fan_2()
-    turn_on_ac()
-
-def freecooling_web():
-    """
-    Activates free cooling mode for web control.
-
-    Opens the damper, turns on fan 1, turns off fan 2, and turns off the AC unit.
-    """
-    open_damper()
-    turn_on_fan_1()
-    turn_off_fan_2()
-    turn_off_ac()
-
-def freecooling_turbo_web():
-    """
-    Activates turbo free cooling mode for web control.
+    Parameters:
+    - bank (RelayBank): The zone's relays, defaults to the relays in config.GPIO_PINS.
 
-    Opens the damper, turns on both fans, and turns off the AC unit.
+    Returns:
+    - dict: Mapping of relay names to True (on/open) or False (off/closed).
     """
-    open_damper()
-    turn_on_fan_1()
-    turn_on_fan_2()
-    turn_off_ac()
+    return {relay: from_level(relay, level) for relay, level in (bank or relays).read().items()}
 
-def passive_cooling_web():
+def decode_mode(states):
     """
-    Activates passive cooling mode for web control.
+    Works out which mode a set of relay states corresponds to.
 
-    Opens the damper, turns off both fans, and turns off the AC unit.
-    """
-    open_damper()
-    turn_off_fan_1()
-    turn_off_fan_2()
-    turn_off_ac()
+    Parameters:
+    - states (dict): Mapping of relay names to on/off, as returned by read_relays().
 
-def emergency_web():
+    Returns:
+    - str: The matching key of MODES, or None if the relays match no mode.
     """
-    Emergency Mode, something has gone wrong.
-    Something like the AC has failed try everything to cool down.
+    for mode, mode_states in MODES.items():
+        if all(states.get(relay) == on for relay, on in mode_states.items()):
+            return mode
+    return None
 
-    Opens the damper, turns on both fans, and turns on the AC unit.
-    """
-    open_damper()
-    turn_on_fan_1()
-    turn_on_fan_2()
-    turn_on_ac()
+def cleanup_gpio():
+    """Cleans up all the GPIO settings by resetting the GPIO pins."""
+    backend.cleanup()
+    if relays is not None:
+        relays.invalidate()
@@ -0,0 +1,102 @@
+import threading
+import syslog
+import config as config
+import metrics
+from mode import check_mode, MANUAL
+
+class CommandQueue:
+    """
+    Mode change commands from the dashboard, waiting for the control loop.
+
+    Web requests only submit() a command and return; the control loop
+    calls apply() at the start of its next tick, so no relay is touched
+    inside a request. Each zone holds at most one pending command and a new
+    one replaces it, so a burst of clicks, a link prefetcher or a retrying
+    client collapses into whatever was asked for last.
+
+    A manual cooling mode that would change the relays is held until they
+    have stayed in their current mode for min_dwell seconds, and is then
+    applied on the first tick after that, unless it has been replaced in the
+    meantime. Emergency and automatic commands are never held: emergency
+    only ever turns cooling on, and the decision engine has dwell times of
+    its own.
+
+    Parameters:
+    - min_dwell (float): Seconds the relays stay in a mode before a manual command may change it.
+    """
+
+    def __init__(self, min_dwell):
+        self.min_dwell = min_dwell
+        self._pending = {}  # Zone name: (control, cooling)
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Registers a callable to be invoked with no arguments after each command is submitted."""
+        self._listeners.append(listener)
+
+    def submit(self, zone, control, cooling=None):
+        """
+        Queues a mode change for a zone, replacing any command still pending for it.
+
+        Parameters:
+        - zone (str): Name of the zone.
+        - control (str): One of 'automatic', 'manual' or 'emergency'.
+        - cooling (str): The cooling mode to hold in manual mode. Ignored otherwise.
+
+        Returns:
+        - dict: The command now pending for the zone, as pending().
+
+        Raises:
+        - ValueError: If the control or cooling mode is invalid.
+        """
+        try:
+            command = check_mode(control, cooling)
+        except ValueError:
+            metrics.COMMANDS.labels(zone, 'rejected').inc()
+            raise
+
+        with self._lock:
+            replaced = self._pending.get(zone)
+            self._pending[zone] = command
+        metrics.COMMANDS.labels(zone, 'submitted').inc()
+        if replaced is not None:
+            metrics.COMMANDS.labels(zone, 'coalesced').inc()
+
+        for listener in self._listeners:
+            listener()
+        return self.pending(zone)
+
+    def pending(self, zone):
+        """Returns the zone's pending command as {'mode', 'cooling'}, or None if there is none."""
+        with self._lock:
+            command = self._pending.get(zone)
+        if command is None:
+            return None
+        return {'mode': command[0], 'cooling': command[1]}
+
+    def apply(self, zones, now):
+        """
+        Hands each zone's pending command to its mode state, unless the relays must dwell first.
+
+        Parameters:
+        - zones (list): The controller's zones.
+        - now (float): Current time in seconds since the epoch.
+        """
+        for zone in zones:
+            with self._lock:
+                command = self._pending.get(zone.name)
+                if command is None:
+                    continue
+                control, cooling = command
+                if (control == MANUAL and zone.current_mode is not None and cooling != zone.current_mode
+                        and zone.changed_at is not None and now - zone.changed_at < self.min_dwell):
+                    zone.log(syslog.LOG_INFO, f"Holding manual {cooling} until the relays have been in {zone.current_mode} for {self.min_dwell:.0f}s",
+                             key='command held', state=(cooling, zone.changed_at))
+                    continue
+                del self._pending[zone.name]
+            zone.mode_state.set(control, cooling)
+            metrics.COMMANDS.labels(zone.name, 'applied').inc()
+
+# Mode changes submitted through the dashboard, applied by the control loop
+command_queue = CommandQueue(config.COMMAND_MIN_DWELL)
@@ -1,9 +1,57 @@
 # Define the time interval (in seconds) between metric evaluations
 evaluation_interval = 10  # Reevaluation period in seconds
 MIN_AC_RUN_TIME = 300 # For example, 5 minutes
+COMMAND_MIN_DWELL = 60 # Seconds the relays hold a mode before a manual command from the dashboard changes it
+
+# Relay wiring, Broadcom (BCM) pin numbers
+GPIO_BACKEND = 'rpi'  # 'rpi' drives real pins through RPi.GPIO, 'fake' keeps them in memory
+GPIO_PINS = {
+    'fan_1': 22,    # WiringPi pin 3
+    'fan_2': 26,    # WiringPi pin 25
+    'ac_unit': 6,   # WiringPi pin 22
+    'damper': 4,    # WiringPi pin 7
+}
+
+# Dashboard, mode controls and the controller's own /metrics are served on this address
+WEB_HOST = '0.0.0.0'
+WEB_PORT = 5000
 
 PROMETHEUS_URL = 'http://10.128.83.10:9090' 
 # PROMETHEUS_URL = 'http://192.168.88.88:9090' # Testing URL
+PROMETHEUS_CONNECT_TIMEOUT = 3.05  # Seconds to establish the connection
+PROMETHEUS_READ_TIMEOUT = 5  # Seconds to wait for a response
+PROMETHEUS_RETRIES = 2  # Retries after the first failed attempt
+PROMETHEUS_RETRY_BUDGET = 8  # Max seconds per query across all attempts, keep below evaluation_interval
+
+# Where readings come from: 'prometheus' queries the TSDB, 'direct' scrapes the sensors' /metrics endpoints
+INPUT_MODE = 'prometheus'
+SENSOR_ENDPOINTS = [
+    'http://192.168.88.50/metrics',
+    'http://192.168.88.83/metrics',
+    'http://192.168.88.84/metrics',
+    'http://192.168.88.85/metrics',
+]
+SENSOR_SCRAPE_TIMEOUT = 2  # Seconds allowed for each sensor in direct mode
+PROMETHEUS_FALLBACK = True  # In direct mode, ask Prometheus for readings no sensor reported
+
+DASHBOARD_MAX_AGE = 30  # Seconds before the dashboard treats readings as stale
+SERIES_RETENTION = 6 * 3600  # Seconds of readings the controller keeps in memory
+
+# Control mode (automatic/manual/emergency) is persisted here only when it changes
+MODE_STATE_FILE = '/var/lib/envirozen/mode.json'
+# Local tools can send mode changes to the controller over this socket
+CONTROL_SOCKET = '/run/envirozen/control.sock'
+# Each evaluation checkpoints the controller's state here, so a restart can resume without an AC cycle
+STATE_SNAPSHOT_FILE = '/dev/shm/envirozen_state.json'
+STATE_SNAPSHOT_MAX_AGE = 120  # Seconds after which a restart ignores the snapshot and starts in AC
+# Backoff, in seconds, between probes for readings while a cold start waits to begin automatic control
+READINESS_INITIAL_BACKOFF = 0.5
+READINESS_MAX_BACKOFF = 30
+READINESS_MAX_WAIT = 300  # Seconds before automatic control starts even with no readings at all
+# Logging goes through a background thread; unchanged states are only logged every LOG_SAMPLE_INTERVAL seconds
+LOG_LEVEL = 'INFO'
+LOG_FORMAT = 'text'  # 'text' or 'json'
+LOG_SAMPLE_INTERVAL = 600
 
 METRIC_THRESHOLDS = {
     'temperature_ambient': 25,  # Max Ambient outdoor temperature
@@ -14,6 +62,28 @@ METRIC_THRESHOLDS = {
     'temperature_cold_warning': 25,  # Warming Cold Aisle temperature
     'temperature_cold_min': 10,  # Minimum Cold Aisle temperature
 }
+# °C a reading must fall below a threshold before the mode steps back down
+METRIC_HYSTERESIS = {
+    'temperature_ambient': 1,
+    'temperature_hot': 1,
+    'temperature_emergency': 1,
+    'temperature_cold': 0.5,
+    'temperature_cold_warning': 0.5,
+    'temperature_cold_min': 0.5,
+}
+# Seconds each mode is held before stepping down; AC uses MIN_AC_RUN_TIME
+MODE_MIN_DWELL = {
+    'passive': 120,
+    'freecooling': 120,
+    'freecooling_turbo': 300,
+    'emergency': 300,
+}
+TREND_WINDOW = 300  # Seconds of readings the trend is estimated over
+TREND_LOOKAHEAD = 300  # Seconds ahead the trend is projected when stepping up, 0 to disable
+# Readings whose newest sample is older than this are treated as missing
+SENSOR_MAX_AGE = 60
+HOT_AISLE_OFFSET = 10  # °C the hot aisle is assumed to run above the cold aisle when one is missing
+HOT_AISLE_MISSING_EMERGENCY = 900  # Seconds without a hot aisle reading before emergency mode
 QUERIES = {
     'temperature_ambient': 'temperature{location="ambient"}',
     'temperature_floor': 'temperature{location="floor"}',
@@ -23,3 +93,7 @@ QUERIES = {
     'temperature_cold_warning': 'temperature{location="cold"}',
     'temperature_cold_min': 'temperature{location="cold"}'
 }
+
+# Rooms driven by this controller, each with its own queries and pins (see config.py.example);
+# empty means one room using the settings above
+ZONES = {}
@@ -0,0 +1,314 @@
+import syslog
+import config as config
+from store import readings_store
+
+# Cooling modes in the order of the integer codes returned by choose_modes(),
+# which is also their order from least to most cooling
+MODE_CODES = ('passive', 'freecooling', 'freecooling_turbo', 'ac', 'emergency')
+
+# Readings the decision rules look at, and so the ones the engine tracks a trend for
+DECISION_READINGS = ('temperature_ambient', 'temperature_cold', 'temperature_hot')
+
+# Thresholds choose_mode() compares each decision reading against
+READING_THRESHOLDS = {
+    'temperature_ambient': ('temperature_ambient',),
+    'temperature_cold': ('temperature_cold_min', 'temperature_cold', 'temperature_cold_warning'),
+    'temperature_hot': ('temperature_hot', 'temperature_emergency'),
+}
+
+def choose_mode(temp_ambient, temp_cold, temp_hot, thresholds):
+    """
+    Picks the cooling mode for one set of temperature readings.
+
+    This is the decision cascade evaluate_metrics() applies every tick. It is
+    pure, so the replay engine can run the same rules over historical data;
+    choose_modes() below is its vectorised twin and must be kept in step.
+
+    Parameters:
+    - temp_ambient (float): Ambient temperature, °C.
+    - temp_cold (float): Cold aisle temperature, °C.
+    - temp_hot (float): Hot aisle temperature, °C.
+    - thresholds (dict): Thresholds keyed as in config.METRIC_THRESHOLDS.
+
+    Returns:
+    - tuple: (mode, syslog priority, log message).
+    """
+    # Load thresholds from config
+    temperature_ambient = thresholds.get('temperature_ambient')
+    temperature_cold_min = thresholds.get('temperature_cold_min')
+    temperature_cold = thresholds.get('temperature_cold')
+    temperature_cold_warning = thresholds.get('temperature_cold_warning')
+    temperature_hot_warning = thresholds.get('temperature_hot')
+    temperature_emergency = thresholds.get('temperature_emergency')  # Emergency threshold
+
+    if temp_hot > temperature_emergency:
+        # Emergency condition: if temperature exceeds emergency threshold
+        return 'emergency', syslog.LOG_CRIT, f"Emergency Mode: Hot Aisle Temperature ({temp_hot}°C) exceeds Emergency Threshold"
+    if temp_hot > temperature_hot_warning or temp_ambient > temperature_ambient:
+        # AC mode: Hot aisle or Ambient temperature above the threshold, turn on AC
+        return 'ac', syslog.LOG_INFO, "Room in AC Mode: Temperature exceeds threshold"
+    if temp_cold < temperature_cold_min:
+        # Passive cooling mode
+        return 'passive', syslog.LOG_INFO, f"Room in Passive Cooling Mode: Cold Aisle Temperature ({temp_cold}°C) is below Minimum"
+    if temperature_cold_min <= temp_cold < temperature_cold:
+        # Free cooling mode
+        return 'freecooling', syslog.LOG_INFO, f"Room in Free Cooling Mode: Cold Aisle Temperature ({temp_cold}°C) is between Min and Normal"
+    if temperature_cold <= temp_cold < temperature_cold_warning:
+        # Freecooling turbo mode
+        return 'freecooling_turbo', syslog.LOG_INFO, f"Room in Freecooling Turbo Mode: Cold Aisle Temperature ({temp_cold}°C) is between Normal and Warning"
+    # AC mode: Cold aisle temperature exceeds warning threshold
+    return 'ac', syslog.LOG_INFO, f"Room in AC Mode: Cold Aisle Temperature ({temp_cold}°C) is above Warning"
+
+def choose_modes(temp_ambient, temp_cold, temp_hot, thresholds):
+    """
+    Vectorised choose_mode() over NumPy arrays of readings.
+
+    Parameters:
+    - temp_ambient, temp_cold, temp_hot (numpy.ndarray): Readings, NaN where missing.
+    - thresholds (dict): Thresholds keyed as in config.METRIC_THRESHOLDS.
+
+    Returns:
+    - numpy.ndarray: Indexes into MODE_CODES, or -1 where any reading is missing.
+    """
+    import numpy as np
+
+    temperature_ambient = thresholds.get('temperature_ambient')
+    temperature_cold_min = thresholds.get('temperature_cold_min')
+    temperature_cold = thresholds.get('temperature_cold')
+    temperature_cold_warning = thresholds.get('temperature_cold_warning')
+    temperature_hot_warning = thresholds.get('temperature_hot')
+    temperature_emergency = thresholds.get('temperature_emergency')
+
+    # np.select takes the first matching condition, mirroring the if-cascade
+    modes = np.select(
+        [
+            temp_hot > temperature_emergency,
+            (temp_hot > temperature_hot_warning) | (temp_ambient > temperature_ambient),
+            temp_cold < temperature_cold_min,
+            (temperature_cold_min <= temp_cold) & (temp_cold < temperature_cold),
+            (temperature_cold <= temp_cold) & (temp_cold < temperature_cold_warning),
+        ],
+        [
+            MODE_CODES.index('emergency'),
+            MODE_CODES.index('ac'),
+            MODE_CODES.index('passive'),
+            MODE_CODES.index('freecooling'),
+            MODE_CODES.index('freecooling_turbo'),
+        ],
+        default=MODE_CODES.index('ac'),
+    ).astype(np.int8)
+
+    missing = np.isnan(temp_ambient) | np.isnan(temp_cold) | np.isnan(temp_hot)
+    modes[missing] = -1
+    return modes
+
+class DecisionEngine:
+    """
+    Stateful wrapper around choose_mode() that stops the controller flapping.
+
+    Four rules sit on top of the plain threshold cascade:
+
+    - Trend: each reading's rate of change over the last trend_window seconds
+      is projected lookahead seconds ahead, and the mode is stepped up as soon
+      as the projection crosses a threshold, so AC comes on before the room
+      gets too warm rather than after. Falling readings are not projected.
+    - Hysteresis: to step down, a reading has to fall the threshold's
+      hysteresis band below it, so a reading sitting on a boundary does not
+      bounce between two modes.
+    - Dwell: a mode is held for at least its minimum dwell before stepping
+      down. Stepping up is never delayed.
+    - Degradation: a missing or stale reading does not stop the decision.
+      Without ambient, free cooling cannot be trusted, so the mode is at
+      least AC. Without one aisle, it is estimated from the other using
+      hot_aisle_offset; without both, the mode is at least AC. Once the hot
+      aisle has been missing for hot_aisle_emergency_after seconds, the mode
+      is emergency.
+
+    Trends come from the readings store, which the control loop appends to
+    before each decision; see TimeSeriesStore.slope().
+
+    Parameters:
+    - store (TimeSeriesStore): Recent readings.
+    - thresholds (dict): Thresholds keyed as in config.METRIC_THRESHOLDS.
+    - hysteresis (dict): Band in °C below each threshold needed to step back down, keyed the same way.
+    - min_dwell (dict): Seconds each mode is held before stepping down, keyed by mode.
+    - trend_window (float): Seconds of readings the trend is estimated over.
+    - lookahead (float): Seconds ahead the trend is projected. 0 disables trend anticipation.
+    - hot_aisle_offset (float): °C the hot aisle is assumed to run above the cold aisle.
+    - hot_aisle_emergency_after (float): Seconds without a hot aisle reading before emergency mode.
+    """
+
+    def __init__(self, store, thresholds, hysteresis=None, min_dwell=None, trend_window=300, lookahead=0,
+                 hot_aisle_offset=10, hot_aisle_emergency_after=900):
+        self.store = store
+        self.thresholds = thresholds
+        self.hysteresis = hysteresis or {}
+        self.min_dwell = min_dwell or {}
+        self.trend_window = trend_window
+        self.lookahead = lookahead
+        self.hot_aisle_offset = hot_aisle_offset
+        self.hot_aisle_emergency_after = hot_aisle_emergency_after
+        # Stepping down is judged against thresholds lowered by their bands
+        self.lower_thresholds = {name: value - self.hysteresis.get(name, 0) for name, value in thresholds.items()}
+
+        self.mode = None   # Mode last decided, None until the first decision
+        self.since = None  # When the engine entered that mode
+        self.held = False  # True if the last decision was held by the minimum dwell
+        self.degraded = False  # True if the last decision had to work around a missing reading
+        self.started = None  # Time of the first decision, from which never-seen readings count as missing
+        store.track(trend_window)
+        store.track(trend_window / 2)
+
+    def reset(self):
+        """Forgets the current mode, e.g. after an operator override, so the next decision is unconstrained."""
+        self.mode = None
+        self.since = None
+        self.held = False
+
+    def snapshot(self):
+        """Returns the engine's mode, dwell and missing-reading clock as a dict, for a state snapshot."""
+        return {'mode': self.mode, 'since': self.since, 'held': self.held,
+                'degraded': self.degraded, 'started': self.started}
+
+    def restore(self, state):
+        """
+        Carries on from a state returned by snapshot(), e.g. after a restart.
+
+        Parameters:
+        - state (dict): As returned by snapshot().
+        """
+        self.mode = state['mode']
+        self.since = state['since']
+        self.held = state['held']
+        self.degraded = state['degraded']
+        self.started = state['started']
+
+    def resume(self, previous):
+        """
+        Carries on from another engine's mode, dwell and missing-reading clock, e.g. after a configuration reload.
+
+        Parameters:
+        - previous (DecisionEngine): The engine being replaced.
+        """
+        self.restore(previous.snapshot())
+
+    def degrade(self, readings, now):
+        """
+        Fills in missing readings and works out the lowest safe mode without them.
+
+        Substitutes are the thresholds themselves, which never trigger a rule
+        on their own, or an estimate from the other aisle.
+
+        Parameters:
+        - readings (dict): Readings keyed by DECISION_READINGS, None where missing or stale.
+        - now (float): Current time, seconds.
+
+        Returns:
+        - tuple: (complete readings as a list in DECISION_READINGS order, lowest mode or None, reasons).
+        """
+        ambient, cold, hot = (readings.get(name) for name in DECISION_READINGS)
+        minimum = None
+        reasons = []
+
+        if ambient is None:
+            ambient = self.thresholds['temperature_ambient']
+            minimum = 'ac'
+            reasons.append("no ambient reading, free cooling disabled")
+
+        if hot is None and cold is not None:
+            hot = cold + self.hot_aisle_offset
+            reasons.append(f"no hot aisle reading, estimated as {hot:.1f}°C from the cold aisle")
+        elif cold is None and hot is not None:
+            cold = hot - self.hot_aisle_offset
+            reasons.append(f"no cold aisle reading, estimated as {cold:.1f}°C from the hot aisle")
+        elif cold is None and hot is None:
+            cold = self.thresholds['temperature_cold_min']
+            hot = self.thresholds['temperature_hot']
+            minimum = 'ac'
+            reasons.append("no aisle readings")
+
+        if readings.get('temperature_hot') is None:
+            last_seen = self.store.last_time('temperature_hot')
+            missing_for = now - (self.started if last_seen is None else last_seen)
+            if missing_for >= self.hot_aisle_emergency_after:
+                minimum = 'emergency'
+                reasons.append(f"hot aisle reading missing for {missing_for:.0f}s")
+
+        return [ambient, cold, hot], minimum, reasons
+
+    def decide(self, readings, now):
+        """
+        Picks the cooling mode for the latest readings.
+
+        Parameters:
+        - readings (dict): Readings keyed by DECISION_READINGS, None where missing or
+          stale, already appended to the store.
+        - now (float): Current time, seconds.
+
+        Returns:
+        - tuple: (mode, syslog priority, log message), as choose_mode().
+        """
+        if self.started is None:
+            self.started = now
+
+        current, minimum, reasons = self.degrade(readings, now)
+        self.degraded = bool(reasons)
+        # Only readings taken this tick have a trend worth projecting
+        projected = [value + (max(0.0, self.store.slope(name, self.trend_window)) * self.lookahead
+                              if readings.get(name) is not None else 0.0)
+                     for name, value in zip(DECISION_READINGS, current)]
+
+        self.held = False
+        target, priority, message = choose_mode(*projected, self.thresholds)
+        if target != choose_mode(*current, self.thresholds)[0]:
+            message += f" (anticipated from trend, projected {', '.join(f'{value:.1f}' for value in projected)}°C)"
+        if minimum is not None and MODE_CODES.index(minimum) > MODE_CODES.index(target):
+            target, priority, message = minimum, syslog.LOG_WARNING, f"Room in {minimum} mode: {'; '.join(reasons)}"
+        elif reasons:
+            priority = min(priority, syslog.LOG_WARNING)
+            message += f" (degraded: {'; '.join(reasons)})"
+
+        if self.mode is None or MODE_CODES.index(target) > MODE_CODES.index(self.mode):
+            return self._enter(target, now), priority, message
+
+        if target == self.mode:
+            return self.mode, priority, message
+
+        # Step down no further than the rising trend allows
+        falling = choose_mode(*current, self.lower_thresholds)
+        if MODE_CODES.index(falling[0]) > MODE_CODES.index(target):
+            target, priority, message = falling
+        if MODE_CODES.index(target) < MODE_CODES.index(self.mode):
+            if now - self.since >= self.min_dwell.get(self.mode, 0):
+                return self._enter(target, now), priority, message
+            self.held = True
+            return self.mode, syslog.LOG_INFO, f"Holding {self.mode} for its minimum dwell before stepping down to {target}"
+
+        return self.mode, syslog.LOG_INFO, f"Staying in {self.mode}: readings within its hysteresis band"
+
+    def _enter(self, mode, now):
+        """Records a change of mode."""
+        if mode != self.mode:
+            self.mode = mode
+            self.since = now
+        return mode
+
+def create_engine(store=readings_store, thresholds=None):
+    """
+    Builds a decision engine from the current configuration.
+
+    Parameters:
+    - store (TimeSeriesStore): Recent readings for the zone being decided.
+    - thresholds (dict): The zone's thresholds, defaults to config.METRIC_THRESHOLDS.
+    """
+    return DecisionEngine(
+        store,
+        config.METRIC_THRESHOLDS if thresholds is None else thresholds,
+        hysteresis=config.METRIC_HYSTERESIS,
+        # The AC's minimum run time is its dwell
+        min_dwell=dict(config.MODE_MIN_DWELL, ac=config.MIN_AC_RUN_TIME),
+        trend_window=config.TREND_WINDOW,
+        lookahead=config.TREND_LOOKAHEAD,
+        hot_aisle_offset=config.HOT_AISLE_OFFSET,
+        hot_aisle_emergency_after=config.HOT_AISLE_MISSING_EMERGENCY,
+    )
@@ -1,165 +1,334 @@
-from prometheus import query_prometheus
+from prometheus import query_samples
+import prometheus
 import config as config
-import actions as actions
+from scrape import scrape_readings
+from scheduler import Scheduler
+import metrics
+from mode import serve_control_socket, AUTOMATIC
+from commands import command_queue
+from ingest import sensor_ingest
+from zones import zones, reconfigure_zones
+from decision import DECISION_READINGS
+from reloader import config_reloader, validate
+from snapshot import state_snapshot
+import server
 import time
-import subprocess
+import asyncio
+import contextlib
+import signal
 import syslog
+import logs
+from logs import log
 
-def start_server():
-    """Start the Flask web server as a separate process."""
-    subprocess.Popen(["python3", "server.py"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+scheduler = None  # Drives the control loop once main() is running
+ready = False  # True once automatic control may run: readings are flowing, or a warm start resumed it
+started = None  # Monotonic time main() was entered, for the time-to-first-decision metric
+decided = False  # True once the control loop has made its first automatic decision
 
-STATUS_FILE = 'status.txt'
-last_ac_activation_time = None
-ac_running = False  # Track whether the AC is currently running
+# Settings the shared Prometheus client is built from
+PROMETHEUS_SETTINGS = {'PROMETHEUS_URL', 'PROMETHEUS_CONNECT_TIMEOUT', 'PROMETHEUS_READ_TIMEOUT',
+                       'PROMETHEUS_RETRIES', 'PROMETHEUS_RETRY_BUDGET'}
 
-def evaluate_metrics():
-    """Evaluate temperature metrics and determine the appropriate cooling mode."""
-    
-    global last_ac_activation_time, ac_running  # Track AC state and last activation time
+def fetch_samples(queries, now):
+    """
+    Fetch the newest sample of every reading from the configured input source.
 
-    # Check if we're in automatic mode
-    with open(STATUS_FILE, 'r') as file:
-        if file.read().strip() != 'automatic':
-            syslog.syslog(syslog.LOG_INFO, "In Manual mode; Envirozen automatic actions paused.")
-            return
+    In 'direct' mode the sensors are scraped concurrently and Prometheus is only
+    consulted, if PROMETHEUS_FALLBACK is set, for readings no sensor reported.
+    Otherwise every reading comes from a single batched Prometheus query. If
+    Prometheus cannot be reached its readings are reported missing, so the
+    decision engine's degradation policy applies rather than the tick failing.
 
-    # Query Prometheus for temperature data
-    def get_temperature(metric_name):
-        query = config.QUERIES.get(metric_name)
-        if not query:
-            syslog.syslog(syslog.LOG_ERR, f"Invalid query for metric '{metric_name}'")
-            return None
-        
-        result = query_prometheus(query=query)
-        if result:
-            temperature = result[0].get('value', [None, None])[1]
-            return float(temperature) if temperature is not None else None
-        return None
-
-    # Get the current temperature readings
-    temp_ambient = get_temperature('temperature_ambient')
-    temp_cold = get_temperature('temperature_cold')
-    temp_hot = get_temperature('temperature_hot')
-
-    if temp_cold is None or temp_hot is None or temp_ambient is None:
-        syslog.syslog(syslog.LOG_ERR, "Failed to get temperature readings")
-        return
+    Parameters:
+    - queries (dict): Mapping of reading keys to query strings.
+    - now (float): Current time, used as the timestamp of scraped readings.
 
-    # Load thresholds from config
-    temperature_ambient = config.METRIC_THRESHOLDS.get('temperature_ambient')
-    temperature_cold_min = config.METRIC_THRESHOLDS.get('temperature_cold_min')
-    temperature_cold = config.METRIC_THRESHOLDS.get('temperature_cold')
-    temperature_cold_warning = config.METRIC_THRESHOLDS.get('temperature_cold_warning')
-    temperature_hot_warning = config.METRIC_THRESHOLDS.get('temperature_hot')
-    temperature_emergency = config.METRIC_THRESHOLDS.get('temperature_emergency')  # Emergency threshold
-
-    # If AC is currently running, check if it has run for at least MIN_AC_RUN_TIME
-    if ac_running and time.time() - last_ac_activation_time < config.MIN_AC_RUN_TIME:
-        # AC is still within the minimum run time, so prevent any mode switches
-        syslog.syslog(syslog.LOG_INFO, "AC running, waiting for minimum runtime before evaluating further actions.")
-        return
+    Returns:
+    - dict: Mapping of reading keys to (timestamp, value) tuples, or None where missing.
+    """
+    if config.INPUT_MODE != 'direct':
+        try:
+            return query_samples(queries, config.SENSOR_MAX_AGE)
+        except Exception as e:
+            log(syslog.LOG_ERR, f"Failed to query readings: {e}", key='query', state=True)
+            return {key: None for key in queries}
 
-    # If the minimum run time has passed, we can switch the AC off or change modes
-    if ac_running and time.time() - last_ac_activation_time >= config.MIN_AC_RUN_TIME:
-        # AC has completed the minimum runtime, allow switching modes
-        ac_running = False  # Reset AC state so it can be switched if necessary
+    readings = asyncio.run(scrape_readings(queries, config.SENSOR_ENDPOINTS, config.SENSOR_SCRAPE_TIMEOUT))
+    samples = {key: None if value is None else (now, value) for key, value in readings.items()}
 
-    # Emergency condition: if temperature exceeds emergency threshold
-    if temp_hot > temperature_emergency:
-        # Emergency mode: Trigger emergency cooling actions
-        actions.emergency(temp_hot)
-        syslog.syslog(syslog.LOG_CRIT, f"Emergency Mode: Hot Aisle Temperature ({temp_hot}°C) exceeds Emergency Threshold")
-        return
+    missing = {key: query for key, query in queries.items() if samples.get(key) is None}
+    if missing and config.PROMETHEUS_FALLBACK:
+        unscraped = sorted(set(missing.values()))
+        log(syslog.LOG_WARNING, f"No direct reading for {', '.join(unscraped)}; falling back to Prometheus", key='fallback', state=tuple(unscraped))
+        try:
+            fallback = query_samples(missing, config.SENSOR_MAX_AGE)
+        except Exception as e:
+            log(syslog.LOG_ERR, f"Prometheus fallback failed: {e}", key='fallback query', state=True)
+        else:
+            samples.update(fallback)
 
-    # Evaluate other conditions based on temperature readings
-    if temp_hot > temperature_hot_warning or temp_ambient > temperature_ambient:
-        # AC mode: Hot aisle or Ambient temperature above the threshold, turn on AC
-        if not ac_running:
-            last_ac_activation_time = time.time()
-            ac_running = True
-            actions.ac_on(temp_hot if temp_hot > temperature_hot_warning else temp_ambient)
-            syslog.syslog(syslog.LOG_INFO, f"Room in AC Mode: Temperature exceeds threshold")
-        return
+    return samples
+
+def evaluate_metrics(readings=None, now=None):
+    """
+    Evaluate every zone's temperature metrics and determine its cooling mode.
+
+    The readings for all zones are fetched together, so sensors that share a
+    metric and label across zones cost a single batched query per tick.
+
+    Parameters:
+    - readings (dict): Readings to evaluate instead of fetching them, keyed by zone
+      name and then metric name. Supplied readings are not checkpointed to the state snapshot.
+    - now (float): Current time in seconds since the epoch, defaults to time.time().
+    """
+    if now is None:
+        now = time.time()
+    live = readings is None
+
+    # Apply any operator command or override straight away, before waiting on readings
+    command_queue.apply(zones, now)
+    for zone in zones:
+        zone.apply_override(now)
+
+    # Fill gaps in the zones' history from readings the sensors pushed since the last tick
+    sensor_ingest.merge(zones)
+
+    # Fetch every zone's readings in one go
+    if readings is None:
+        queries = {(zone.name, name): query for zone in zones for name, query in zone.queries.items()}
+        with metrics.PHASE_DURATION.labels('query').time():
+            samples = fetch_samples(queries, now)
+        # A reading pushed since Prometheus last scraped, such as one that woke this tick, is the newer one
+        for key, sample in sensor_ingest.latest(queries).items():
+            if sample is not None and (samples[key] is None or sample[0] > samples[key][0]):
+                samples[key] = sample
+        readings = {}
+        for zone in zones:
+            readings[zone.name] = zone.fresh_readings({name: samples[(zone.name, name)] for name in zone.queries}, now)
+
+    for zone in zones:
+        zone.evaluate(readings.get(zone.name, {}), now)
+
+    # Checkpoint the outcome so a restart can carry on from here
+    if live:
+        state_snapshot.save(zones, now)
+
+def warm_start():
+    """
+    Resumes every zone from a recent state snapshot, if there is one.
+
+    Returns:
+    - bool: True if every zone resumed, False if the controller must cold start.
+    """
+    snapshot = state_snapshot.load(time.time())
+    if snapshot is None:
+        return False
+    age, states = snapshot
+    if any(zone.name not in states for zone in zones):
+        return False
+
+    try:
+        for zone in zones:
+            zone.restore(states[zone.name])
+    except (KeyError, TypeError, ValueError) as e:
+        log(syslog.LOG_WARNING, f"Ignoring unusable state snapshot: {e}")
+        for zone in zones:
+            zone.reset()
+        return False
+
+    resumed = ', '.join(f"{zone.name} in {zone.current_mode}" for zone in zones)
+    log(syslog.LOG_INFO, f"Warm restart from a snapshot {age:.0f}s old: resumed {resumed}")
+    return True
+
+def apply_config(changed):
+    """
+    Brings the running controller in line with reloaded settings.
+
+    Zones keep their readings, modes and dwell timers and the relays are left
+    as they are, so there is no safe-start AC cycle; the next tick simply
+    decides with the new settings.
+
+    Parameters:
+    - changed (set): Names of the settings that changed.
+    """
+    reconfigure_zones()
+    logs.configure()
+    if changed & PROMETHEUS_SETTINGS:
+        prometheus.client = prometheus.create_client()
+    state_snapshot.path = config.STATE_SNAPSHOT_FILE
+    state_snapshot.max_age = config.STATE_SNAPSHOT_MAX_AGE
+    command_queue.min_dwell = config.COMMAND_MIN_DWELL
+    if scheduler is not None:
+        scheduler.interval = config.evaluation_interval
+
+def readings_available():
+    """
+    Checks whether the input source is answering with any of the zones' decision readings.
+
+    Readings that are still missing are left to the decision engine's
+    degradation policy, so one dead sensor does not hold up automatic control.
 
-    if temp_cold < temperature_cold_min:
-        # Passive cooling mode
-        actions.passive_cooling(temp_cold)
-        syslog.syslog(syslog.LOG_INFO, f"Room in Passive Cooling Mode: Cold Aisle Temperature ({temp_cold}°C) is below Minimum")
-    elif temperature_cold_min <= temp_cold < temperature_cold:
-        # Free cooling mode
-        actions.freecooling(temp_cold)
-        syslog.syslog(syslog.LOG_INFO, f"Room in Free Cooling Mode: Cold Aisle Temperature ({temp_cold}°C) is between Min and Normal")
-    elif temperature_cold <= temp_cold < temperature_cold_warning:
-        # Freecooling turbo mode
-        actions.freecooling_turbo(temp_cold)
-        syslog.syslog(syslog.LOG_INFO, f"Room in Freecooling Turbo Mode: Cold Aisle Temperature ({temp_cold}°C) is between Normal and Warning")
-    else:
-        # AC mode: Cold aisle temperature exceeds warning threshold
-        if not ac_running:
-            last_ac_activation_time = time.time()
-            ac_running = True
-            actions.ac_on(temp_cold)
-            syslog.syslog(syslog.LOG_INFO, f"Room in AC Mode: Cold Aisle Temperature ({temp_cold}°C) is above Warning")
-
-def wait_for_dependencies():
-    """Wait for required services to be available before starting."""
-    max_wait_time = 300  # 5 minutes
-    start_time = time.time()
-    
-    syslog.syslog(syslog.LOG_INFO, "Waiting for dependencies to become available...")
-    
-    while time.time() - start_time < max_wait_time:
+    Returns:
+    - bool: True if a fresh value came back for at least one reading the decision rules need.
+    """
+    now = time.time()
+    queries = {(zone.name, name): zone.queries[name] for zone in zones for name in DECISION_READINGS}
+    samples = fetch_samples(queries, now)
+    return any(sample is not None and now - sample[0] <= config.SENSOR_MAX_AGE for sample in samples.values())
+
+async def probe_dependencies():
+    """
+    Waits in the background for the first readings, then starts automatic control.
+
+    Prometheus, or the sensors in direct mode, are probed with exponential
+    backoff from READINESS_INITIAL_BACKOFF up to READINESS_MAX_BACKOFF seconds,
+    so a slow-booting Prometheus is picked up within moments of coming up while
+    a long outage costs little. The relays stay in the safe state meanwhile,
+    but for no longer than READINESS_MAX_WAIT seconds: after that automatic
+    control starts anyway and the decision engine's degradation policy deals
+    with the missing readings, escalating to emergency if the hot aisle stays
+    unknown, just as it would for an outage while running.
+    """
+    log(syslog.LOG_INFO, "Waiting for readings before starting automatic control...")
+    delay = config.READINESS_INITIAL_BACKOFF
+    while True:
         try:
-            # Test Prometheus connectivity
-            test_query = 'up'
-            result = query_prometheus(test_query)
-            if result is not None:
-                syslog.syslog(syslog.LOG_INFO, "Prometheus connectivity confirmed")
-                return True
+            if await asyncio.to_thread(readings_available):
+                log(syslog.LOG_INFO, f"Readings available after {time.monotonic() - started:.1f}s, starting automatic control")
+                break
         except Exception as e:
-            syslog.syslog(syslog.LOG_INFO, f"Waiting for Prometheus... ({e})")
-            
-        time.sleep(10)  # Wait 10 seconds before retry
-    
-    syslog.syslog(syslog.LOG_ERR, "Timed out waiting for dependencies")
-    return False
+            log(syslog.LOG_INFO, f"Waiting for readings... ({e})", key='probe', state=True)
+        if time.monotonic() - started >= config.READINESS_MAX_WAIT:
+            log(syslog.LOG_WARNING, f"No readings after {config.READINESS_MAX_WAIT}s, starting automatic control without them")
+            break
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, config.READINESS_MAX_BACKOFF)
+
+    global ready
+    ready = True
+    metrics.READY.set(1)
+    scheduler.wake()
+
+def probe_finished(task):
+    """Logs a readiness probe that failed, since nothing else awaits its result."""
+    if not task.cancelled() and task.exception() is not None:
+        log(syslog.LOG_ERR, f"Waiting for readings failed, staying in the safe state: {task.exception()!r}")
+
+def hold_safe_state():
+    """Keeps zones in AC until readings arrive, while still applying operator overrides."""
+    command_queue.apply(zones, time.time())
+    sensor_ingest.merge(zones)
+    for zone in zones:
+        if zone.apply_override()['mode'] == AUTOMATIC and zone.current_mode != 'ac':
+            zone.set_mode('ac')
 
 def main():
-    """Main function to start the server and continuously evaluate metrics."""
-    syslog.syslog(syslog.LOG_INFO, "Envirozen service starting...")
-    
-    # Wait for dependencies to be ready
-    if not wait_for_dependencies():
-        syslog.syslog(syslog.LOG_ERR, "Failed to initialize dependencies, exiting")
+    """Main function to initialise the hardware, then run the control loop and web server."""
+    global ready, started
+    started = time.monotonic()
+    log(syslog.LOG_INFO, "Envirozen service starting...")
+
+    problems = validate(vars(config))
+    if problems:
+        log(syslog.LOG_ERR, f"Invalid configuration, exiting: {'; '.join(problems)}")
         return
-    
-    # Start the web server
-    start_server()
-    syslog.syslog(syslog.LOG_INFO, "Web server started")
-    
-    # Initialize GPIO to safe state
+
+    # After an upgrade or crash, carry on in the previous mode; the control
+    # loop copes with Prometheus being unavailable, so there is no need to wait
     try:
-        import actions
-        actions.ac_on(0)  # Start in safe AC mode
-        syslog.syslog(syslog.LOG_INFO, "GPIO initialized to safe state (AC ON)")
+        ready = warm_start()
     except Exception as e:
-        syslog.syslog(syslog.LOG_ERR, f"Failed to initialize GPIO: {e}")
-        return
-    
-    syslog.syslog(syslog.LOG_INFO, "Envirozen service fully operational")
-    
-    # Main control loop
-    while True:
+        log(syslog.LOG_ERR, f"Failed to resume from the state snapshot: {e}")
+        ready = False
+
+    if not ready:
+        # A cold start hands every zone back to automatic control; a warm
+        # restart keeps the operator's control mode loaded from its state file
+        for zone in zones:
+            zone.mode_state.set(AUTOMATIC)
+
+        # Initialize GPIO to safe state straight away; readings are waited
+        # for in the background once the control loop is running
         try:
-            evaluate_metrics()
+            for zone in zones:
+                zone.set_mode('ac')  # Start in safe AC mode
+            log(syslog.LOG_INFO, "GPIO initialized to safe state (AC ON)")
         except Exception as e:
-            syslog.syslog(syslog.LOG_ERR, f"Error in main loop: {e}")
-            # Continue running but log the error
-        time.sleep(config.evaluation_interval)
+            log(syslog.LOG_ERR, f"Failed to initialize GPIO: {e}")
+            return
+    metrics.READY.set(1 if ready else 0)
+
+    log(syslog.LOG_INFO, "Envirozen service fully operational")
+
+    # Main control loop and web server, sharing one event loop
+    asyncio.run(control_loop())
+
+async def evaluate_tick():
+    """Run one evaluation off the event loop so blocking I/O cannot stall the scheduler."""
+    global decided
+    try:
+        # Pick up edits to config.py between ticks, so no tick sees half of one
+        config_reloader.check()
+        if not ready:
+            await asyncio.to_thread(hold_safe_state)
+        else:
+            await asyncio.to_thread(evaluate_metrics)
+            if not decided:
+                decided = True
+                metrics.TIME_TO_FIRST_DECISION.set(time.monotonic() - started)
+        # Push whatever changed to the dashboard's subscribers
+        server.feed.publish()
+    except Exception as e:
+        log(syslog.LOG_ERR, f"Error in main loop: {e}")
+        # Continue running but log the error
+
+async def control_loop():
+    """Evaluate metrics at a fixed rate, plus immediately whenever the scheduler is woken."""
+    global scheduler
+    scheduler = Scheduler(config.evaluation_interval, evaluate_tick)
+    metrics.register_scheduler(scheduler)
+
+    # SIGUSR1, a dashboard command, a control mode change or a pushed reading crossing a threshold
+    # requests an immediate out-of-band evaluation
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, scheduler.wake)
+    command_queue.add_listener(scheduler.wake)
+    sensor_ingest.add_listener(scheduler.wake)
+    for zone in zones:
+        zone.mode_state.add_listener(scheduler.wake)
+
+    # config.py is reloaded when it changes, or straight away on SIGHUP
+    def reload_now():
+        config_reloader.request()
+        scheduler.wake()
+    config_reloader.add_listener(apply_config)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_now)
+
+    # Accept mode changes from local tools over a Unix socket
+    await serve_control_socket({zone.name: zone.mode_state for zone in zones}, config.CONTROL_SOCKET)
+
+    # Serve the dashboard and the controller's own /metrics from this process
+    await server.start_server(config.WEB_HOST, config.WEB_PORT)
+    log(syslog.LOG_INFO, f"Web server started on port {config.WEB_PORT}")
+
+    # Start automatic control as soon as readings arrive, without holding up the loop
+    probe = None
+    if not ready:
+        probe = asyncio.create_task(probe_dependencies())
+        probe.add_done_callback(probe_finished)
+
+    try:
+        await scheduler.run()
+    finally:
+        # On shutdown, stop waiting for readings along with the control loop
+        if probe is not None and not probe.done():
+            probe.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await probe
 
 if __name__ == "__main__":
-    # Set default mode to automatic
-    with open(STATUS_FILE, 'w') as file:
-        file.write('automatic')  
+    logs.setup()
+    # Pick up each zone's last control mode; main() returns it to automatic unless this is a warm restart
+    for zone in zones:
+        zone.mode_state.load()
     main()
+
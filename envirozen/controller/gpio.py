@@ -0,0 +1,88 @@
+# Pin levels shared by every backend
+HIGH = 1
+LOW = 0
+
+class RPiGPIOBackend:
+    """
+    GPIO backend driving the Raspberry Pi's pins through RPi.GPIO.
+
+    Pins are numbered using Broadcom SOC channel numbers.
+    """
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+
+        # Disable GPIO warnings
+        GPIO.setwarnings(False)
+
+        # Use Broadcom SOC channel numbers
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_output(self, pin):
+        """Configures a pin as an output."""
+        self.GPIO.setup(pin, self.GPIO.OUT)
+
+    def write(self, pins, levels):
+        """Drives several pins in a single call."""
+        self.GPIO.output(list(pins), list(levels))
+
+    def read(self, pin):
+        """Returns the current level of a pin."""
+        return self.GPIO.input(pin)
+
+    def cleanup(self):
+        """Resets every pin this process configured."""
+        self.GPIO.cleanup()
+
+class FakeBackend:
+    """
+    In-memory GPIO backend for running the controller off a Pi.
+
+    Pin levels are kept in a dict so they can be read back, and every write is
+    counted, which lets the simulator and benchmarks run the real control code.
+    """
+
+    def __init__(self):
+        self.levels = {}
+        self.writes = 0  # Number of write() calls
+
+    def setup_output(self, pin):
+        """Configures a pin as an output, initially LOW."""
+        self.levels.setdefault(pin, LOW)
+
+    def write(self, pins, levels):
+        """Drives several pins in a single call."""
+        self.writes += 1
+        self.levels.update(zip(pins, levels))
+
+    def read(self, pin):
+        """Returns the current level of a pin."""
+        return self.levels.get(pin, LOW)
+
+    def cleanup(self):
+        """Resets every pin."""
+        self.levels.clear()
+
+# Available backends, selected by config.GPIO_BACKEND
+BACKENDS = {
+    'rpi': RPiGPIOBackend,
+    'fake': FakeBackend,
+}
+
+def create_backend(name):
+    """
+    Creates the named GPIO backend.
+
+    Parameters:
+    - name (str): A key of BACKENDS.
+
+    Returns:
+    - object: The backend instance.
+
+    Raises:
+    - ValueError: If no backend has that name.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown GPIO backend '{name}', expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
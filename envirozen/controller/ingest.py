@@ -0,0 +1,162 @@
+import threading
+import syslog
+from collections import deque
+import config as config
+import metrics
+from decision import READING_THRESHOLDS
+from prometheus import SELECTOR_PATTERN
+from scrape import parse_exposition
+
+# Pushed samples further ahead of the controller's clock than this, in seconds, are dropped;
+# those less far ahead are taken as current
+MAX_CLOCK_SKEW = 60
+# Batches held for the control loop; if it falls this far behind the oldest are dropped
+MAX_PENDING = 64
+
+class SensorIngest:
+    """
+    Batches of readings pushed by the sensors, waiting to be merged.
+
+    A sensor keeps a ring buffer of its readings and pushes them to
+    /api/ingest as Prometheus text exposition with a timestamp on each
+    sample, so readings taken while it was off the network still reach the
+    controller once it is back. The web server only parses a batch and
+    queues it; the control loop merges the queued batches into the zones'
+    readings stores at the start of its next tick, so the stores are only
+    ever written from the loop. Samples are matched to each zone's queries
+    the way direct scraping matches them, and only fill gaps in the zone's
+    history; readings the controller already has are left alone.
+
+    The newest fresh sample of each series is also kept, so a tick uses a
+    pushed reading when it is newer than the one it fetched. A pushed reading
+    that takes one of its zone's readings across a threshold, or is the first
+    seen for it, notifies the listeners so the control loop need not wait for
+    its next tick.
+    """
+
+    def __init__(self):
+        self._pending = deque(maxlen=MAX_PENDING)
+        self._latest = {}  # (metric, labels): newest fresh (timestamp, value) pushed
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Registers a callable to be invoked with no arguments when a pushed reading crosses a threshold."""
+        self._listeners.append(listener)
+
+    def submit(self, text, now, zones):
+        """
+        Queues a pushed batch for the control loop.
+
+        Parameters:
+        - text (str): Samples in Prometheus text exposition format, with millisecond timestamps.
+        - now (float): Current time in seconds since the epoch, used for samples without a timestamp.
+        - zones (list): The controller's zones, whose thresholds the fresh samples are checked against.
+
+        Returns:
+        - int: Number of samples queued.
+        """
+        batch = []
+        for name, labels, value, timestamp in parse_exposition(text, timestamps=True):
+            if timestamp is None:
+                timestamp = now
+            elif timestamp > now + MAX_CLOCK_SKEW or timestamp < now - config.SERIES_RETENTION:
+                # Too far ahead to trust, or too old for the zones' history to hold
+                continue
+            # A sample slightly ahead is placed at now, as stored readings must never be newer than the present
+            timestamp = min(timestamp, now)
+            batch.append((name, labels, value, timestamp))
+        if not batch:
+            return 0
+
+        # Note each fresh sample newer than the last one pushed for its series, with the value it replaces
+        updated = []
+        with self._lock:
+            self._pending.append(batch)
+            for name, labels, value, timestamp in batch:
+                if now - timestamp > config.SENSOR_MAX_AGE:
+                    continue
+                series = (name, tuple(sorted(labels.items())))
+                previous = self._latest.get(series)
+                if previous is None or timestamp > previous[0]:
+                    self._latest[series] = (timestamp, value)
+                    updated.append((name, labels, None if previous is None else previous[1], value))
+
+        if any(self._crossed(zone, updated) for zone in zones):
+            for listener in self._listeners:
+                listener()
+        return len(batch)
+
+    def _crossed(self, zone, updated):
+        """Returns True if an updated sample is the zone's first for a reading or takes it across one of its thresholds."""
+        thresholds = zone.engine.thresholds
+        for reading, query in zone.queries.items():
+            match = SELECTOR_PATTERN.match(query or '')
+            if not match:
+                continue
+            metric, label, label_value = match.groups()
+            for name, labels, previous, value in updated:
+                if name != metric or labels.get(label) != label_value:
+                    continue
+                if previous is None:
+                    return True
+                for threshold in READING_THRESHOLDS.get(reading, ()):
+                    limit = thresholds.get(threshold)
+                    if limit is not None and ((previous > limit) != (value > limit) or (previous < limit) != (value < limit)):
+                        return True
+        return False
+
+    def latest(self, queries):
+        """
+        Returns the newest pushed sample for each query, as fetch_samples() does.
+
+        Parameters:
+        - queries (dict): Mapping of reading keys to query strings.
+
+        Returns:
+        - dict: Mapping of reading keys to (timestamp, value) tuples, or None where nothing was pushed.
+        """
+        with self._lock:
+            latest = list(self._latest.items())
+        samples = {}
+        for key, query in queries.items():
+            samples[key] = None
+            match = SELECTOR_PATTERN.match(query or '')
+            if not match:
+                continue
+            metric, label, label_value = match.groups()
+            for (name, labels), sample in latest:
+                if name == metric and dict(labels).get(label) == label_value and (samples[key] is None or sample[0] > samples[key][0]):
+                    samples[key] = sample
+        return samples
+
+    def merge(self, zones):
+        """
+        Backfills the zones' readings stores from every batch queued since the last call.
+
+        Parameters:
+        - zones (list): The controller's zones.
+        """
+        with self._lock:
+            batches = list(self._pending)
+            self._pending.clear()
+        if not batches:
+            return
+
+        for zone in zones:
+            points = {}
+            for query in set(zone.store.queries.values()):
+                match = SELECTOR_PATTERN.match(query or '')
+                if not match:
+                    continue
+                metric, label, value = match.groups()
+                points[query] = [(timestamp, sample) for batch in batches
+                                 for name, labels, sample, timestamp in batch
+                                 if name == metric and labels.get(label) == value]
+            merged = zone.store.merge(points)
+            if merged:
+                metrics.INGESTED_SAMPLES.labels(zone.name).inc(merged)
+                zone.log(syslog.LOG_INFO, f"Backfilled {merged} readings pushed by sensors")
+
+# Readings pushed by the sensors, merged by the control loop
+sensor_ingest = SensorIngest()
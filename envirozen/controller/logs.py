@@ -0,0 +1,163 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import syslog
+import threading
+from collections import OrderedDict
+import config as config
+import metrics
+
+# Logging levels for the syslog priorities used throughout the controller
+PRIORITY_LEVELS = {
+    syslog.LOG_EMERG: logging.CRITICAL,
+    syslog.LOG_ALERT: logging.CRITICAL,
+    syslog.LOG_CRIT: logging.CRITICAL,
+    syslog.LOG_ERR: logging.ERROR,
+    syslog.LOG_WARNING: logging.WARNING,
+    syslog.LOG_NOTICE: logging.INFO,
+    syslog.LOG_INFO: logging.INFO,
+    syslog.LOG_DEBUG: logging.DEBUG,
+}
+
+SYSLOG_SOCKET = '/dev/log'
+
+# Most keys the rate limiter remembers; the least recently logged are forgotten first
+MAX_KEYS = 1024
+
+logger = logging.getLogger('envirozen')
+
+def log(priority, message, key=None, state=None, **fields):
+    """
+    Logs a message from the controller.
+
+    Messages that carry a key describe the state of something, such as a
+    zone's cooling mode. They are written when the state changes and
+    otherwise only sampled, once every LOG_SAMPLE_INTERVAL seconds. Messages
+    without a key are written unless they repeat the last identical message
+    within that interval. Either way the next message written notes how many
+    were held back.
+
+    The record is handed to a background thread for formatting and writing,
+    so logging never blocks the control loop on syslog or the SD card.
+
+    Parameters:
+    - priority (int): A syslog priority such as syslog.LOG_INFO.
+    - message (str): The message.
+    - key (hashable): What the message is about, e.g. ('mode', zone name). None for a one-off message.
+    - state (hashable): The state being reported for the key, defaults to the message itself.
+    - fields: Structured fields to log alongside the message, e.g. zone='room1'.
+    """
+    logger.log(PRIORITY_LEVELS[priority], message, extra={'key': key, 'state': state, 'fields': fields})
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops repeats of the same state, or the same message, within an interval.
+
+    Applies to every record on its way into the queue, whether it came from
+    log() or straight from the logging module, so both share one policy.
+
+    Parameters:
+    - interval (float): Seconds between samples of an unchanged state.
+    """
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self._last = OrderedDict()  # key: [state, time last written, records held back since]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'key', None)
+        if key is None:
+            key = (record.name, record.levelno, record.getMessage())
+            state = None
+        else:
+            state = getattr(record, 'state', None)
+            if state is None:
+                state = record.getMessage()
+
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and last[0] == state and record.created - last[1] < self.interval:
+                last[2] += 1
+                metrics.LOG_SUPPRESSED.inc()
+                return False
+
+            suppressed = last[2] if last is not None else 0
+            self._last[key] = [state, record.created, 0]
+            self._last.move_to_end(key)
+            if len(self._last) > MAX_KEYS:
+                self._last.popitem(last=False)
+
+        if suppressed:
+            record.fields = dict(getattr(record, 'fields', None) or {}, suppressed=suppressed)
+        return True
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Formats a record with its structured fields.
+
+    'text' appends the fields to the message as key=value pairs, which is what
+    syslog and journalctl show best; 'json' writes one JSON object per line
+    for log shippers.
+
+    Parameters:
+    - style (str): 'text' or 'json'.
+    """
+
+    def __init__(self, style='text'):
+        super().__init__()
+        self.style = style
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        if self.style == 'json':
+            return json.dumps(dict(level=record.levelname.lower(), message=record.getMessage(), **fields), default=str)
+        message = record.getMessage()
+        if fields:
+            message += ' ' + ' '.join(f"{name}={value}" for name, value in fields.items())
+        return message
+
+rate_limit = RateLimitFilter(config.LOG_SAMPLE_INTERVAL)
+listener = None
+
+def setup():
+    """
+    Sends all of the controller's logging through a queue to syslog.
+
+    Both log() and plain logging calls from any module go to the root
+    logger's queue handler, which only enqueues; a listener thread formats
+    the records and writes them to syslog, or to stderr where there is no
+    syslog socket. Safe to call more than once.
+    """
+    global listener
+    if listener is not None:
+        return
+
+    if os.path.exists(SYSLOG_SOCKET):
+        target = logging.handlers.SysLogHandler(address=SYSLOG_SOCKET, facility=logging.handlers.SysLogHandler.LOG_USER)
+        target.ident = 'envirozen: '
+    else:
+        target = logging.StreamHandler()
+    target.setFormatter(StructuredFormatter(config.LOG_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(rate_limit)
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    configure()
+
+    listener = logging.handlers.QueueListener(records, target)
+    listener.start()
+    atexit.register(listener.stop)
+
+def configure():
+    """Applies LOG_LEVEL and LOG_SAMPLE_INTERVAL, e.g. after the configuration is reloaded."""
+    logging.getLogger().setLevel(config.LOG_LEVEL)
+    rate_limit.interval = config.LOG_SAMPLE_INTERVAL
@@ -0,0 +1,110 @@
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Buckets cover everything from a cached GPIO write to a Prometheus retry budget
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PHASE_DURATION = Histogram(
+    'envirozen_evaluation_phase_seconds',
+    'Time spent in each phase of evaluate_metrics()',
+    ['phase'],  # query, decision or actuation
+    buckets=LATENCY_BUCKETS,
+)
+PROMETHEUS_REQUEST_DURATION = Histogram(
+    'envirozen_prometheus_request_seconds',
+    'Latency of individual HTTP requests to Prometheus, including failed attempts',
+    buckets=LATENCY_BUCKETS,
+)
+PROMETHEUS_ERRORS = Counter(
+    'envirozen_prometheus_errors',
+    'Prometheus queries that failed after exhausting their retries',
+)
+MODE = Gauge(
+    'envirozen_mode',
+    'Cooling mode the controller last applied, 1 for the active mode and 0 otherwise',
+    ['zone', 'mode'],
+)
+MODE_TRANSITIONS = Counter(
+    'envirozen_mode_transitions',
+    'Changes of the applied cooling mode',
+    ['zone', 'from_mode', 'to_mode'],
+)
+DWELL_HOLDS = Counter(
+    'envirozen_dwell_holds',
+    'Evaluations that stayed in a mode because it had not yet been held for its minimum dwell',
+    ['zone', 'mode'],
+)
+READING_AGE = Gauge(
+    'envirozen_reading_age_seconds',
+    'Age of the newest sample of each reading when it was last fetched',
+    ['zone', 'reading'],
+)
+DEGRADED = Gauge(
+    'envirozen_degraded',
+    '1 while the last decision relied on the degradation policy for a missing or stale reading',
+    ['zone'],
+)
+RELAY_ACTUATIONS = Counter(
+    'envirozen_relay_actuations',
+    'Relay state changes, for estimating relay wear',
+    ['zone', 'relay'],
+)
+CONFIG_RELOADS = Counter(
+    'envirozen_config_reloads',
+    'Edits to config.py picked up without a restart',
+    ['result'],  # applied or rejected
+)
+READY = Gauge(
+    'envirozen_ready',
+    '1 once automatic control is running, 0 while holding the safe state waiting for readings',
+)
+TIME_TO_FIRST_DECISION = Gauge(
+    'envirozen_time_to_first_decision_seconds',
+    'Seconds from the controller starting to its first automatic decision',
+)
+COMMANDS = Counter(
+    'envirozen_commands',
+    'Mode change commands from the dashboard',
+    ['zone', 'result'],  # submitted, coalesced (replaced a pending command), applied or rejected
+)
+INGESTED_SAMPLES = Counter(
+    'envirozen_ingested_samples',
+    "Readings pushed by the sensors that filled gaps in a zone's history",
+    ['zone'],
+)
+LOG_SUPPRESSED = Counter(
+    'envirozen_log_messages_suppressed',
+    'Log messages held back because they repeated an unchanged state or message',
+)
+
+def record_mode(zone, previous, mode):
+    """
+    Records that the controller applied a cooling mode.
+
+    Parameters:
+    - zone (str): The zone whose relays were driven.
+    - previous (str): The mode that was active before, or None if unknown.
+    - mode (str): The mode that has just been applied.
+    """
+    if previous is not None:
+        MODE.labels(zone, previous).set(0)
+    MODE.labels(zone, mode).set(1)
+    if previous != mode:
+        MODE_TRANSITIONS.labels(zone, previous or 'none', mode).inc()
+
+class SchedulerCollector:
+    """Exposes the control loop scheduler's tick statistics at scrape time."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def collect(self):
+        yield CounterMetricFamily('envirozen_scheduler_ticks', 'Scheduled control loop ticks run', value=self.scheduler.ticks)
+        yield CounterMetricFamily('envirozen_scheduler_wakeups', 'Out-of-band control loop ticks run', value=self.scheduler.wakeups)
+        yield CounterMetricFamily('envirozen_scheduler_overruns', 'Scheduled ticks skipped because a tick ran too long', value=self.scheduler.overruns)
+        yield GaugeMetricFamily('envirozen_scheduler_jitter_seconds', 'Lateness of the last scheduled tick', value=self.scheduler.last_jitter)
+        yield GaugeMetricFamily('envirozen_scheduler_tick_duration_seconds', 'Duration of the last tick', value=self.scheduler.last_duration)
+
+def register_scheduler(scheduler):
+    """Adds the scheduler's statistics to the exported metrics."""
+    REGISTRY.register(SchedulerCollector(scheduler))
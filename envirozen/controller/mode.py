@@ -0,0 +1,208 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import syslog
+from logs import log
+import config as config
+from actions import MODES
+
+# Control modes: who decides which cooling mode the relays are in
+AUTOMATIC = 'automatic'  # The control loop decides from the sensor readings
+MANUAL = 'manual'        # An operator picked a cooling mode from the dashboard
+EMERGENCY = 'emergency'  # An operator forced everything on
+CONTROL_MODES = (AUTOMATIC, MANUAL, EMERGENCY)
+
+def check_mode(control, cooling=None):
+    """
+    Validates a control mode and settles which cooling mode it holds.
+
+    Parameters:
+    - control (str): One of 'automatic', 'manual' or 'emergency'.
+    - cooling (str): The cooling mode to hold in manual mode. Ignored otherwise.
+
+    Returns:
+    - tuple: (control, cooling), cooling being None in automatic mode and 'emergency' in emergency mode.
+
+    Raises:
+    - ValueError: If the control or cooling mode is invalid.
+    """
+    if control not in CONTROL_MODES:
+        raise ValueError(f"Unknown control mode '{control}'")
+    if control == MANUAL and cooling not in MODES:
+        raise ValueError(f"Manual mode needs a cooling mode, one of {', '.join(MODES)}")
+    if control == AUTOMATIC:
+        cooling = None
+    elif control == EMERGENCY:
+        cooling = 'emergency'
+    return control, cooling
+
+class ModeState:
+    """
+    Control mode state machine, owned by the controller process.
+
+    Tracks whether the controller is in automatic, manual or emergency mode
+    and, outside automatic mode, which cooling mode the operator asked for.
+    The state lives in memory; it is only written to disk when it changes,
+    atomically via a rename, so the control loop does no per-tick disk I/O
+    and readers never see a half-written file.
+
+    Listeners registered with add_listener() are called after every change,
+    which is how the control loop is woken to apply an override immediately.
+
+    Parameters:
+    - path (str): Location of the persisted state file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.control = AUTOMATIC
+        self.cooling = None  # Requested cooling mode outside automatic mode
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Registers a callable to be invoked with no arguments after each change."""
+        self._listeners.append(listener)
+
+    def set(self, control, cooling=None):
+        """
+        Moves the state machine into a new control mode.
+
+        Parameters:
+        - control (str): One of 'automatic', 'manual' or 'emergency'.
+        - cooling (str): The cooling mode to hold in manual mode. Ignored otherwise.
+
+        Returns:
+        - bool: True if the state changed.
+
+        Raises:
+        - ValueError: If the control or cooling mode is invalid.
+        """
+        control, cooling = check_mode(control, cooling)
+
+        with self._lock:
+            if (control, cooling) == (self.control, self.cooling):
+                return False
+            self.control, self.cooling = control, cooling
+            self._save()
+
+        log(syslog.LOG_INFO, f"Control mode changed to {control}" + (f" ({cooling})" if control == MANUAL else ""))
+        for listener in self._listeners:
+            listener()
+        return True
+
+    def snapshot(self):
+        """Returns the current state as a dict."""
+        with self._lock:
+            return {'mode': self.control, 'cooling': self.cooling}
+
+    def load(self):
+        """
+        Reloads the state from the persisted file, keeping the current state if there is none.
+
+        A file that holds no valid state, such as one edited by hand or left
+        by an older version, is ignored with a warning and the state falls
+        back to automatic.
+        """
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+        try:
+            control, cooling = check_mode(data['mode'], data['cooling'])
+        except (KeyError, TypeError, ValueError) as e:
+            log(syslog.LOG_WARNING, f"Ignoring unusable control mode in {self.path} ({e!r}); falling back to {AUTOMATIC}")
+            control, cooling = AUTOMATIC, None
+        with self._lock:
+            self.control, self.cooling = control, cooling
+
+    def _save(self):
+        """Atomically persists the state. Called with the lock held."""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.mode-')
+            with os.fdopen(fd, 'w') as file:
+                json.dump({'mode': self.control, 'cooling': self.cooling}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log(syslog.LOG_ERR, f"Failed to persist control mode to {self.path}: {e}")
+
+async def serve_control_socket(mode_states, path):
+    """
+    Accepts mode change commands on a local Unix socket.
+
+    Each request is a single line of JSON such as
+    {"zone": "room1", "mode": "manual", "cooling": "ac"} and is answered with
+    a line of JSON holding the zone's resulting state, or an error. The zone
+    may be left out when there is only one. A request without a mode just
+    returns the current state.
+
+    Parameters:
+    - mode_states (dict): The state machine of each zone, keyed by zone name.
+    - path (str): Filesystem path of the socket.
+
+    Returns:
+    - asyncio.AbstractServer: The running server.
+    """
+    async def handle(reader, writer):
+        try:
+            request = json.loads(await reader.readline() or b'{}')
+            zone = request.get('zone')
+            if zone is None:
+                if len(mode_states) > 1:
+                    raise ValueError(f"Several zones are controlled, name one of {', '.join(mode_states)}")
+                zone = next(iter(mode_states))
+            if zone not in mode_states:
+                raise ValueError(f"Unknown zone '{zone}'")
+            if 'mode' in request:
+                mode_states[zone].set(request['mode'], request.get('cooling'))
+            response = dict(mode_states[zone].snapshot(), zone=zone, ok=True)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            response = {'ok': False, 'error': str(e)}
+        writer.write(json.dumps(response).encode() + b'\n')
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(handle, path=path)
+
+def send_command(path, control=None, cooling=None, timeout=2, zone=None):
+    """
+    Sends a mode change to the controller over its control socket.
+
+    Parameters:
+    - path (str): Filesystem path of the controller's socket.
+    - control (str): The control mode to switch to, or None to only read the state.
+    - cooling (str): The cooling mode to hold in manual mode.
+    - timeout (float): Seconds to wait for the controller.
+    - zone (str): The zone to change, required when the controller drives several.
+
+    Returns:
+    - dict: The controller's response.
+
+    Raises:
+    - OSError: If the controller cannot be reached.
+    - ValueError: If the controller rejected the command.
+    """
+    request = {} if control is None else {'mode': control, 'cooling': cooling}
+    if zone is not None:
+        request['zone'] = zone
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        response = json.loads(sock.makefile('rb').readline())
+    if not response.get('ok'):
+        raise ValueError(response.get('error', 'Command rejected'))
+    return response
+
+# Control mode of this controller
+mode_state = ModeState(config.MODE_STATE_FILE)
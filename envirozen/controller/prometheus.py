@@ -1,41 +1,78 @@
+import re
+import math
+import time
+import random
 import requests
 import logging
-from config import PROMETHEUS_URL
+import syslog
+from requests.adapters import HTTPAdapter
+import config as config
+import metrics
+from logs import log
 
-# Configure logging (You can configure this in the main file if it's a bigger project)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Prometheus rejects range queries returning more than 11,000 points per series
+MAX_RANGE_POINTS = 10000
 
-def query_prometheus(query):
+class PrometheusClient:
     """
-    Queries the Prometheus API for the given query.
+    Reusable client for the Prometheus HTTP API.
+
+    Holds a pooled keep-alive session so successive control loop iterations
+    reuse the same TCP connection, bounds every request with connect/read
+    timeouts, and retries transient failures with jittered exponential backoff
+    inside a fixed time budget so a slow or hung Prometheus cannot stall the loop.
 
     Parameters:
-    - query (str): The Prometheus query string to be executed.
+    - url (str): Base URL of the Prometheus server.
+    - connect_timeout (float): Seconds to wait for the TCP connection.
+    - read_timeout (float): Seconds to wait for a response once connected.
+    - retries (int): Maximum number of retries after the first attempt.
+    - retry_budget (float): Total seconds a query may spend across all attempts.
+    - backoff (float): Base delay in seconds for the exponential backoff.
+    - pool_size (int): Number of connections kept alive in the pool.
+    """
 
-    Returns:
-    - list: The results of the query if successful.
+    def __init__(self, url, connect_timeout=3.05, read_timeout=5, retries=2,
+                 retry_budget=8, backoff=0.5, pool_size=2):
+        self.url = url.rstrip('/')
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.backoff = backoff
+        self.last_latency = None  # Seconds taken by the most recent HTTP request
 
-    Raises:
-    - ValueError: If the query is invalid (empty or None).
-    - Exception: If the query fails or returns an error.
-    """
-    # Validate the query
-    if not query:
-        logging.error("The Prometheus query is empty or None.")
-        raise ValueError("Prometheus query cannot be empty or None.")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def query(self, query):
+        """
+        Queries the Prometheus API for the given query.
+
+        Parameters:
+        - query (str): The Prometheus query string to be executed.
+
+        Returns:
+        - list: The results of the query if successful.
+
+        Raises:
+        - ValueError: If the query is invalid (empty or None).
+        - Exception: If the query fails or returns an error.
+        """
+        # Validate the query
+        if not query:
+            logging.error("The Prometheus query is empty or None.")
+            raise ValueError("Prometheus query cannot be empty or None.")
 
-    try:
         # Log the query being sent
-        logging.info(f"Sending Prometheus query: {query}")
+        logging.debug(f"Sending Prometheus query: {query}")
 
-        # Send a GET request to the Prometheus query API
-        response = requests.get(f'{PROMETHEUS_URL}/api/v1/query', params={'query': query})
+        response = self._get('/api/v1/query', params={'query': query})
 
         # Log the response status code
-        logging.info(f"Prometheus query response status: {response.status_code}")
-
-        # Raise an error for bad responses (4xx and 5xx status codes)
-        response.raise_for_status()
+        logging.debug(f"Prometheus query response status: {response.status_code}")
 
         # Parse the JSON response
         data = response.json()
@@ -44,13 +81,248 @@ def query_prometheus(query):
         if data['status'] != 'success':
             logging.error(f"Prometheus query failed with error: {data.get('error', 'Unknown error')}")
             logging.error(f"Prometheus full response: {data}")
+            metrics.PROMETHEUS_ERRORS.inc()
             raise Exception(f"Failed to query Prometheus: {data.get('error', 'Unknown error')}")
 
         # Log successful query result
-        logging.info(f"Prometheus query successful, results count: {len(data['data']['result'])}")
+        logging.debug(f"Prometheus query successful, results count: {len(data['data']['result'])}")
         return data['data']['result']
 
-    except requests.exceptions.RequestException as e:
-        # Log the exception related to the request
-        logging.error(f"Request to Prometheus failed: {str(e)}")
-        raise Exception(f"Request to Prometheus failed: {str(e)}")
+    def query_range(self, query, start, end, step):
+        """
+        Queries the Prometheus API for a range of samples.
+
+        Prometheus refuses ranges of more than 11,000 points per series, so
+        long windows are fetched in chunks of MAX_RANGE_POINTS and stitched
+        back together.
+
+        Parameters:
+        - query (str): The Prometheus query string to be executed.
+        - start (float): Start of the range, Unix seconds.
+        - end (float): End of the range, Unix seconds.
+        - step (float): Seconds between samples.
+
+        Returns:
+        - list: Matrix entries as returned by Prometheus, each with 'metric' and 'values'.
+
+        Raises:
+        - ValueError: If the query is invalid (empty or None).
+        - Exception: If the query fails or returns an error.
+        """
+        if not query:
+            logging.error("The Prometheus query is empty or None.")
+            raise ValueError("Prometheus query cannot be empty or None.")
+
+        logging.debug(f"Sending Prometheus range query: {query}")
+
+        series = {}
+        chunk_start = start
+        while chunk_start <= end:
+            chunk_end = min(end, chunk_start + step * (MAX_RANGE_POINTS - 1))
+            response = self._get('/api/v1/query_range', params={
+                'query': query, 'start': chunk_start, 'end': chunk_end, 'step': step})
+            data = response.json()
+
+            if data['status'] != 'success':
+                logging.error(f"Prometheus range query failed with error: {data.get('error', 'Unknown error')}")
+                metrics.PROMETHEUS_ERRORS.inc()
+                raise Exception(f"Failed to query Prometheus: {data.get('error', 'Unknown error')}")
+
+            # Merge each chunk into the series with the same labels
+            for entry in data['data']['result']:
+                key = tuple(sorted(entry.get('metric', {}).items()))
+                series.setdefault(key, {'metric': entry.get('metric', {}), 'values': []})['values'].extend(entry['values'])
+            chunk_start = chunk_end + step
+
+        return list(series.values())
+
+    def _get(self, path, params):
+        """
+        Sends a GET request, retrying connection errors, timeouts and 5xx responses.
+
+        Each attempt's connect and read timeouts are clamped to whatever is
+        left of the retry budget, and the delay before a retry is drawn uniformly from
+        [0, backoff * 2^attempt) ("full jitter") so several clients do not
+        retry in lockstep.
+        """
+        deadline = time.monotonic() + self.retry_budget
+        attempt = 0
+
+        while True:
+            remaining = max(0.1, deadline - time.monotonic())
+            start = time.monotonic()
+            try:
+                response = self.session.get(
+                    f'{self.url}{path}',
+                    params=params,
+                    timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                )
+                self.last_latency = time.monotonic() - start
+                metrics.PROMETHEUS_REQUEST_DURATION.observe(self.last_latency)
+
+                # Raise an error for bad responses (4xx and 5xx status codes)
+                response.raise_for_status()
+                return response
+
+            except requests.exceptions.RequestException as e:
+                if e.response is None:
+                    self.last_latency = time.monotonic() - start
+                    metrics.PROMETHEUS_REQUEST_DURATION.observe(self.last_latency)
+
+                # Client errors will not succeed on a retry
+                status = getattr(e.response, 'status_code', None)
+                retryable = status is None or status >= 500
+
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                attempt += 1
+                if not retryable or attempt > self.retries or time.monotonic() + delay >= deadline:
+                    # Reported as a state, so an outage logs once per LOG_SAMPLE_INTERVAL rather than every tick
+                    log(syslog.LOG_ERR, f"Request to Prometheus failed after {attempt} attempt(s): {str(e)}", key='prometheus request', state=True)
+                    metrics.PROMETHEUS_ERRORS.inc()
+                    raise Exception(f"Request to Prometheus failed: {str(e)}")
+
+                log(syslog.LOG_WARNING, f"Request to Prometheus failed, retrying in {delay:.2f}s: {str(e)}", key='prometheus retry', state=True)
+                time.sleep(delay)
+
+def create_client():
+    """Builds a client from the current configuration."""
+    return PrometheusClient(
+        config.PROMETHEUS_URL,
+        connect_timeout=config.PROMETHEUS_CONNECT_TIMEOUT,
+        read_timeout=config.PROMETHEUS_READ_TIMEOUT,
+        retries=config.PROMETHEUS_RETRIES,
+        retry_budget=config.PROMETHEUS_RETRY_BUDGET,
+    )
+
+# Shared client used by the module-level helpers below, rebuilt when the configuration is reloaded
+client = create_client()
+
+def query_prometheus(query):
+    """
+    Queries the Prometheus API for the given query using the shared client.
+
+    Parameters:
+    - query (str): The Prometheus query string to be executed.
+
+    Returns:
+    - list: The results of the query if successful.
+
+    Raises:
+    - ValueError: If the query is invalid (empty or None).
+    - Exception: If the query fails or returns an error.
+    """
+    return client.query(query)
+
+# Matches simple selectors such as temperature{location="cold"}, which can be
+# folded together with their siblings into a single regex matcher.
+SELECTOR_PATTERN = re.compile(r'^\s*(\w+)\{\s*(\w+)\s*=\s*"([\w-]+)"\s*\}\s*$')
+
+def query_samples(queries, max_age):
+    """
+    Fetches the newest sample of every query along with when it was taken.
+
+    An instant query reports the time it was evaluated, not when the sample
+    was scraped, so simple selectors are instead sent as a range selector
+    over the last max_age seconds, batched by _group_selectors(), and the
+    newest sample of each series is kept with its own timestamp. A sensor
+    with nothing newer than max_age comes back as None. Other queries are
+    sent as instant queries and carry the evaluation time.
+
+    Parameters:
+    - queries (dict): Mapping of metric names to Prometheus query strings, usually config.QUERIES.
+    - max_age (float): Oldest sample to accept, in seconds.
+
+    Returns:
+    - dict: Mapping of metric names to (timestamp, float value) tuples, or None where there is no recent sample.
+
+    Raises:
+    - Exception: If any of the underlying Prometheus requests fail.
+    """
+    samples = {metric_name: None for metric_name in queries}
+    lookback = f'{max(1, math.ceil(max_age))}s'
+
+    groups, others = _group_selectors(queries)
+    for metric_name, query in others.items():
+        result = query_prometheus(query)
+        if result and _sample_value(result[0]) is not None:
+            samples[metric_name] = (float(result[0]['value'][0]), _sample_value(result[0]))
+
+    for (metric, label), members in groups.items():
+        values = '|'.join(sorted(members))
+        result = query_prometheus(f'{metric}{{{label}=~"{values}"}}[{lookback}]')
+
+        for entry in result:
+            value = entry.get('metric', {}).get(label)
+            points = _sample_values(entry)
+            for metric_name in members.get(value, []):
+                if points:
+                    samples[metric_name] = points[-1]
+
+    return samples
+
+def query_range_readings(queries, start, end, step):
+    """
+    Fetches a range of samples for every query, batched by _group_selectors().
+
+    Parameters:
+    - queries (dict): Mapping of metric names to Prometheus query strings, usually config.QUERIES.
+    - start (float): Start of the range, Unix seconds.
+    - end (float): End of the range, Unix seconds.
+    - step (float): Seconds between samples.
+
+    Returns:
+    - dict: Mapping of metric names to lists of (timestamp, float value) pairs, empty where Prometheus had no data.
+
+    Raises:
+    - Exception: If any of the underlying Prometheus requests fail.
+    """
+    series = {metric_name: [] for metric_name in queries}
+
+    groups, others = _group_selectors(queries)
+    for metric_name, query in others.items():
+        result = client.query_range(query, start, end, step)
+        series[metric_name] = _sample_values(result[0]) if result else []
+
+    for (metric, label), members in groups.items():
+        values = '|'.join(sorted(members))
+        result = client.query_range(f'{metric}{{{label}=~"{values}"}}', start, end, step)
+
+        for entry in result:
+            value = entry.get('metric', {}).get(label)
+            for metric_name in members.get(value, []):
+                series[metric_name] = _sample_values(entry)
+
+    return series
+
+def _group_selectors(queries):
+    """
+    Groups simple selectors by (metric, label) so each group costs one request.
+
+    Simple selectors that share a metric and label, such as
+    temperature{location="cold"} and temperature{location="hot"}, are sent as
+    one regex selector, e.g. temperature{location=~"cold|hot"}, and the
+    returned vector is split back out by label. Duplicate selectors are only
+    fetched once. Anything more complex is sent as its own query.
+
+    Returns:
+    - tuple: ({(metric, label): {label value: [metric names]}}, {metric name: query} for everything else).
+    """
+    groups = {}
+    others = {}
+    for metric_name, query in queries.items():
+        match = SELECTOR_PATTERN.match(query or '')
+        if not match:
+            others[metric_name] = query
+            continue
+        metric, label, value = match.groups()
+        groups.setdefault((metric, label), {}).setdefault(value, []).append(metric_name)
+    return groups, others
+
+def _sample_value(entry):
+    """Returns the float value of an instant-vector entry, or None if it has none."""
+    value = entry.get('value', [None, None])[1]
+    return float(value) if value is not None else None
+
+def _sample_values(entry):
+    """Returns the (timestamp, float value) pairs of a range-vector entry."""
+    return [(float(timestamp), float(value)) for timestamp, value in entry.get('values', [])]
@@ -1,36 +1,25 @@
-import RPi.GPIO as GPIO
+import config as config
+import gpio
 import time
 
 def main():
-    # Use Broadcom SOC channel numbers
-    GPIO.setmode(GPIO.BCM)
-    
-    # Pin setup
-    GPIO.setup(4, GPIO.OUT)   # Corresponds to WiringPi pin 7
-    GPIO.setup(22, GPIO.OUT)  # Corresponds to WiringPi pin 3
-    GPIO.setup(6, GPIO.OUT)   # Corresponds to WiringPi pin 22
-    GPIO.setup(26, GPIO.OUT)  # Corresponds to WiringPi pin 25
-    
+    # Use the configured backend, so the test also runs off a Pi with 'fake'
+    backend = gpio.create_backend(config.GPIO_BACKEND)
+
+    # Pin setup, pulsed in wiring order: damper, fan 1, AC, fan 2
+    pins = [config.GPIO_PINS[name] for name in ('damper', 'fan_1', 'ac_unit', 'fan_2')]
+    for pin in pins:
+        backend.setup_output(pin)
+
     print("relay testing!")
 
     try:
         while True:
-            GPIO.output(4, GPIO.HIGH)
-            time.sleep(0.5)
-            GPIO.output(4, GPIO.LOW)
-
-            GPIO.output(22, GPIO.HIGH)
-            time.sleep(0.5)
-            GPIO.output(22, GPIO.LOW)
-
-            GPIO.output(6, GPIO.HIGH)
-            time.sleep(0.5)
-            GPIO.output(6, GPIO.LOW)
+            for pin in pins:
+                backend.write([pin], [gpio.HIGH])
+                time.sleep(0.5)
+                backend.write([pin], [gpio.LOW])
 
-            GPIO.output(26, GPIO.HIGH)
-            time.sleep(0.5)
-            GPIO.output(26, GPIO.LOW)
-            
             time.sleep(0.5)
 
     except KeyboardInterrupt:
@@ -39,7 +28,7 @@ def main():
 
     finally:
         # Cleanup the GPIO settings
-        GPIO.cleanup()
+        backend.cleanup()
 
 if __name__ == "__main__":
     main()
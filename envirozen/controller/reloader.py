@@ -0,0 +1,238 @@
+import os
+import runpy
+import syslog
+from logs import log
+import types
+import config as config
+import metrics
+from actions import MODES
+from decision import DECISION_READINGS
+
+# Settings that are bound to hardware, sockets or buffer sizes when the
+# controller starts; a reload keeps their running values until a restart
+RESTART_SETTINGS = (
+    'GPIO_BACKEND', 'GPIO_PINS', 'WEB_HOST', 'WEB_PORT', 'CONTROL_SOCKET',
+    'MODE_STATE_FILE', 'SERIES_RETENTION', 'LOG_FORMAT',
+)
+
+# Relays every cooling mode drives, and so the ones each zone needs a pin for
+REQUIRED_RELAYS = tuple(sorted({relay for states in MODES.values() for relay in states}))
+
+# Thresholds the decision rules need, see decision.choose_mode()
+REQUIRED_THRESHOLDS = (
+    'temperature_ambient', 'temperature_cold_min', 'temperature_cold',
+    'temperature_cold_warning', 'temperature_hot', 'temperature_emergency',
+)
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def validate(settings):
+    """
+    Checks a set of settings for mistakes that would break the control loop.
+
+    Parameters:
+    - settings (dict): Mapping of setting names to values, as in config.py.
+
+    Returns:
+    - list: A description of each problem found, empty if the settings are valid.
+    """
+    problems = []
+
+    def check_number(name, value, minimum=0, strict=False):
+        if not is_number(value) or value < minimum or (strict and value == minimum):
+            problems.append(f"{name} must be a number {'above' if strict else 'of at least'} {minimum}, not {value!r}")
+
+    def check_thresholds(name, thresholds):
+        if not isinstance(thresholds, dict):
+            problems.append(f"{name} must be a dict")
+            return
+        found = len(problems)
+        for key in REQUIRED_THRESHOLDS:
+            if key not in thresholds:
+                problems.append(f"{name} is missing '{key}'")
+            elif not is_number(thresholds[key]):
+                problems.append(f"{name}['{key}'] must be a number, not {thresholds[key]!r}")
+        if len(problems) > found:
+            return
+        if not thresholds['temperature_cold_min'] <= thresholds['temperature_cold'] <= thresholds['temperature_cold_warning']:
+            problems.append(f"{name} must have temperature_cold_min <= temperature_cold <= temperature_cold_warning")
+        if thresholds['temperature_hot'] > thresholds['temperature_emergency']:
+            problems.append(f"{name} must have temperature_hot <= temperature_emergency")
+
+    def check_queries(name, queries):
+        if not isinstance(queries, dict) or not all(isinstance(query, str) for query in queries.values()):
+            problems.append(f"{name} must map reading names to query strings")
+            return
+        for reading in DECISION_READINGS:
+            if reading not in queries:
+                problems.append(f"{name} is missing '{reading}'")
+
+    def check_pins(name, pins):
+        missing = [relay for relay in REQUIRED_RELAYS if relay not in pins]
+        if missing:
+            problems.append(f"{name} is missing {', '.join(repr(relay) for relay in missing)}")
+        if len(set(pins.values())) < len(pins):
+            problems.append(f"{name} uses a pin for more than one relay")
+
+    check_number('evaluation_interval', settings.get('evaluation_interval'), strict=True)
+    check_thresholds('METRIC_THRESHOLDS', settings.get('METRIC_THRESHOLDS'))
+    check_queries('QUERIES', settings.get('QUERIES'))
+
+    for name, value in settings.get('METRIC_HYSTERESIS', {}).items():
+        check_number(f"METRIC_HYSTERESIS['{name}']", value)
+    for mode, value in settings.get('MODE_MIN_DWELL', {}).items():
+        if mode not in MODES:
+            problems.append(f"MODE_MIN_DWELL has unknown mode '{mode}'")
+        check_number(f"MODE_MIN_DWELL['{mode}']", value)
+    for name in ('MIN_AC_RUN_TIME', 'COMMAND_MIN_DWELL', 'TREND_LOOKAHEAD', 'HOT_AISLE_OFFSET', 'HOT_AISLE_MISSING_EMERGENCY'):
+        check_number(name, settings.get(name))
+    for name in ('TREND_WINDOW', 'SENSOR_MAX_AGE', 'DASHBOARD_MAX_AGE', 'READINESS_INITIAL_BACKOFF', 'READINESS_MAX_BACKOFF', 'READINESS_MAX_WAIT'):
+        check_number(name, settings.get(name), strict=True)
+
+    if settings.get('LOG_LEVEL') not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        problems.append(f"LOG_LEVEL must be one of DEBUG, INFO, WARNING, ERROR or CRITICAL, not {settings.get('LOG_LEVEL')!r}")
+    if settings.get('LOG_FORMAT') not in ('text', 'json'):
+        problems.append(f"LOG_FORMAT must be 'text' or 'json', not {settings.get('LOG_FORMAT')!r}")
+    check_number('LOG_SAMPLE_INTERVAL', settings.get('LOG_SAMPLE_INTERVAL'))
+
+    zones = settings.get('ZONES', {})
+    if not isinstance(zones, dict):
+        problems.append("ZONES must be a dict")
+        zones = {}
+    used_pins = {}  # Pin: zone driving it
+    for zone, spec in zones.items():
+        if not isinstance(spec, dict) or not isinstance(spec.get('gpio_pins'), dict):
+            problems.append(f"ZONES['{zone}'] needs a 'gpio_pins' dict")
+            continue
+        check_pins(f"ZONES['{zone}']['gpio_pins']", spec['gpio_pins'])
+        for pin in set(spec['gpio_pins'].values()):
+            if pin in used_pins:
+                problems.append(f"ZONES['{zone}'] and ZONES['{used_pins[pin]}'] both use pin {pin!r}")
+            else:
+                used_pins[pin] = zone
+        check_queries(f"ZONES['{zone}']['queries']", spec.get('queries'))
+        if isinstance(settings.get('METRIC_THRESHOLDS'), dict):
+            check_thresholds(f"ZONES['{zone}'] thresholds", dict(settings['METRIC_THRESHOLDS'], **spec.get('thresholds', {})))
+    if not zones:
+        if isinstance(settings.get('GPIO_PINS'), dict):
+            check_pins('GPIO_PINS', settings['GPIO_PINS'])
+        else:
+            problems.append("GPIO_PINS must be a dict")
+
+    return problems
+
+def zone_layout(zones):
+    """Returns the parts of a ZONES setting that are fixed at startup: each zone's name, pins and state file."""
+    return {name: (spec.get('gpio_pins'), spec.get('mode_state_file')) for name, spec in zones.items()}
+
+class ConfigReloader:
+    """
+    Applies edits to config.py without restarting the controller.
+
+    check() is called between control loop ticks, and request() makes the
+    next check reload unconditionally. It compares the file's
+    modification time and size with the last load, which costs one stat(),
+    and only when they change re-runs the file into a fresh namespace and
+    validates it. A file that fails to run or validate is logged and ignored,
+    leaving the running settings untouched. Valid settings are copied onto the
+    config module in one step and the listeners registered with add_listener()
+    are called to bring the running controller in line, so a tick never sees
+    half of an edit.
+
+    Settings in RESTART_SETTINGS, and any change to which zones exist or how
+    they are wired, keep their running values; a warning says a restart is
+    needed for them.
+
+    Parameters:
+    - path (str): Location of config.py.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._signature = self._stat()
+        self._requested = False
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Registers a callable to be invoked with the set of changed setting names after each reload."""
+        self._listeners.append(listener)
+
+    def request(self):
+        """Makes the next check() reload even if the file looks unchanged, e.g. on SIGHUP."""
+        self._requested = True
+
+    def check(self):
+        """
+        Reloads the configuration if the file has changed since it was last loaded.
+
+        Returns:
+        - set: Names of the settings that changed, empty if nothing was applied.
+        """
+        signature = self._stat()
+        if signature is None or (signature == self._signature and not self._requested):
+            return set()
+        self._signature = signature
+        self._requested = False
+
+        try:
+            settings = load_settings(self.path)
+        except Exception as e:
+            log(syslog.LOG_ERR, f"Ignoring {self.path}, it failed to load: {e}")
+            metrics.CONFIG_RELOADS.labels('rejected').inc()
+            return set()
+
+        problems = validate(settings)
+        if problems:
+            log(syslog.LOG_ERR, f"Ignoring {self.path}, it is invalid: {'; '.join(problems)}")
+            metrics.CONFIG_RELOADS.labels('rejected').inc()
+            return set()
+
+        return self.apply(settings)
+
+    def apply(self, settings):
+        """
+        Copies validated settings onto the config module and notifies the listeners.
+
+        Returns:
+        - set: Names of the settings that changed.
+        """
+        missing = object()
+        changed = {name for name, value in settings.items() if getattr(config, name, missing) != value}
+
+        held = changed & set(RESTART_SETTINGS)
+        if 'ZONES' in changed and zone_layout(settings['ZONES']) != zone_layout(getattr(config, 'ZONES', {})):
+            held.add('ZONES')
+        if held:
+            log(syslog.LOG_WARNING, f"Restart Envirozen to apply {', '.join(sorted(held))}")
+        changed -= held
+
+        for name in changed:
+            setattr(config, name, settings[name])
+        if changed:
+            metrics.CONFIG_RELOADS.labels('applied').inc()
+            log(syslog.LOG_INFO, f"Configuration reloaded: {', '.join(sorted(changed))}")
+            for listener in self._listeners:
+                listener(changed)
+        return changed
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+def load_settings(path):
+    """
+    Runs a configuration file and returns its settings.
+
+    Returns:
+    - dict: Mapping of setting names to values, leaving out modules, functions and private names.
+    """
+    namespace = runpy.run_path(path)
+    return {name: value for name, value in namespace.items()
+            if not name.startswith('_') and not isinstance(value, types.ModuleType) and not callable(value)}
+
+# Watches the config.py the controller was started with
+config_reloader = ConfigReloader(config.__file__)
@@ -0,0 +1,301 @@
+import argparse
+import time
+import numpy as np
+import config as config
+
+# Replay only reads the mode table, so keep actions away from the real relays
+config.GPIO_BACKEND = 'fake'
+
+import actions
+from decision import MODE_CODES, DECISION_READINGS, choose_modes, create_engine
+from prometheus import query_range_readings
+from zones import get_zone
+
+AC = MODE_CODES.index('ac')
+
+def load_prometheus(queries, start, end, step):
+    """
+    Pulls the queried series out of Prometheus onto a uniform time grid.
+
+    Parameters:
+    - queries (dict): Mapping of metric names to Prometheus query strings, usually config.QUERIES.
+    - start (float): Start of the window, Unix seconds.
+    - end (float): End of the window, Unix seconds.
+    - step (float): Seconds between samples.
+
+    Returns:
+    - tuple: (timestamps array, {metric name: values array}), with NaN where a sample is missing.
+    """
+    timestamps = np.arange(start, end + step / 2, step, dtype=np.float64)
+    series = {}
+    for metric_name, samples in query_range_readings(queries, start, end, step).items():
+        values = np.full(len(timestamps), np.nan)
+        if samples:
+            points = np.asarray(samples, dtype=np.float64)
+            index = np.rint((points[:, 0] - start) / step).astype(np.int64)
+            inside = (index >= 0) & (index < len(timestamps))
+            values[index[inside]] = points[inside, 1]
+        series[metric_name] = values
+    return timestamps, series
+
+def load_dump(path):
+    """Reads a dump written by save_dump()."""
+    with np.load(path) as data:
+        return data['timestamps'], {name: data[name] for name in data.files if name != 'timestamps'}
+
+def save_dump(path, timestamps, series):
+    """Writes the timestamps and series to a compressed .npz file for later replays."""
+    np.savez_compressed(path, timestamps=timestamps, **series)
+
+def window_edges(timestamps, length):
+    """
+    Finds, for every sample, the first sample later than length seconds before it.
+
+    On a uniform grid, which is what load_prometheus() builds, that is a fixed
+    number of samples back and needs no search, so the lag is returned
+    instead and callers can slice rather than index.
+
+    Returns:
+    - int or numpy.ndarray: How many samples back each edge is on a uniform grid, else the index of each edge.
+    """
+    steps = np.diff(timestamps)
+    if len(steps) and np.all(steps == steps[0]):
+        return int(np.ceil(length / steps[0])) - 1
+    return np.searchsorted(timestamps, timestamps - length, side='right')
+
+def trends(timestamps, series, window):
+    """
+    Vectorised TimeSeriesStore.slope() at every sample, for several readings.
+
+    Running sums over the samples the store would have held make each
+    window's half means a difference of two prefix sums. The readings share
+    their timestamps, so the window edges are only found once, and on a
+    uniform grid the sums are padded with zeros in front so that the sums at
+    every sample's edges are a slice of them rather than a gather.
+
+    Parameters:
+    - timestamps (numpy.ndarray): Sample times in seconds, ascending.
+    - series (dict): Each reading's values, NaN where missing.
+    - window (float): The engine's trend window, seconds.
+
+    Returns:
+    - dict: Trend in °C per second at each sample, keyed as series, 0 where the reading is missing.
+    """
+    count = len(timestamps)
+    # The window holds samples after now - window, split at now - window / 2
+    start = window_edges(timestamps, window)
+    split = window_edges(timestamps, window / 2)
+    pad = max([lag for lag in (start, split) if isinstance(lag, int)], default=0)
+    # Measure time from the first sample so the sums keep their precision
+    elapsed = timestamps - timestamps[0]
+
+    def before(sums, edges):
+        """Returns the total of the samples before each sample's edge."""
+        if isinstance(edges, int):
+            return sums[pad - edges:pad - edges + count]
+        return sums[pad + edges]
+
+    def window_sums(samples):
+        # sums[pad + i] is the total of the first i samples
+        sums = np.zeros(pad + count + 1)
+        np.cumsum(samples, out=sums[pad + 1:])
+        at_split = before(sums, split)
+        return at_split - before(sums, start), sums[pad + 1:] - at_split
+
+    slopes = {}
+    shared = []  # (valid, counts and time sums) for each distinct set of missing samples
+    for name, values in series.items():
+        valid = ~np.isnan(values)
+        # Readings missing the same samples, such as all of them while Prometheus was down, share their counts
+        for seen, sums in shared:
+            if np.array_equal(seen, valid):
+                older, newer, older_time, newer_time, usable = sums
+                break
+        else:
+            older, newer = window_sums(valid)
+            older_time, newer_time = window_sums(np.where(valid, elapsed, 0.0))
+            usable = valid & (older > 0) & (newer > 0)
+            shared.append((valid, (older, newer, older_time, newer_time, usable)))
+        older_sum, newer_sum = window_sums(np.where(valid, values, 0.0))
+
+        # The difference of the halves' means, with both sides multiplied by the two counts
+        rise = newer_sum * older
+        rise -= older_sum * newer
+        run = newer_time * older
+        run -= older_time * newer
+        slope = np.zeros(count)
+        np.divide(rise, run, out=slope, where=usable)
+        slopes[name] = slope
+    return slopes
+
+def degrade(timestamps, series, engine):
+    """
+    Vectorised DecisionEngine.degrade() at every sample.
+
+    Returns:
+    - tuple: (complete readings in DECISION_READINGS order, lowest mode code at each sample or -1).
+    """
+    ambient, cold, hot = (series[name] for name in DECISION_READINGS)
+    has_ambient, has_cold, has_hot = ~np.isnan(ambient), ~np.isnan(cold), ~np.isnan(hot)
+    thresholds = engine.thresholds
+
+    ambient = np.where(has_ambient, ambient, thresholds['temperature_ambient'])
+    estimated_hot = np.where(has_cold, cold + engine.hot_aisle_offset, thresholds['temperature_hot'])
+    estimated_cold = np.where(has_hot, hot - engine.hot_aisle_offset, thresholds['temperature_cold_min'])
+    hot = np.where(has_hot, hot, estimated_hot)
+    cold = np.where(has_cold, cold, estimated_cold)
+
+    minimum = np.where(~has_ambient | (~has_cold & ~has_hot), AC, -1)
+
+    # Time since the hot aisle was last seen, counting from the first decision
+    last_seen = np.maximum.accumulate(np.where(has_hot, np.arange(len(timestamps)), -1))
+    missing_for = timestamps - np.where(last_seen >= 0, timestamps[np.maximum(last_seen, 0)], timestamps[0])
+    minimum[~has_hot & (missing_for >= engine.hot_aisle_emergency_after)] = MODE_CODES.index('emergency')
+
+    return [ambient, cold, hot], minimum
+
+def replay(timestamps, series, engine):
+    """
+    Runs the automatic mode decision logic over a series of readings.
+
+    Every rule in DecisionEngine.decide() that depends only on the readings,
+    namely degradation, trends, projections and the thresholds with and
+    without their hysteresis bands, is evaluated for all samples at once.
+    What is left is a state machine that only changes at a few samples: the
+    next mode change is either the first later sample calling for a higher
+    mode, or the first sample after the dwell calling for a lower one, and
+    both are found by binary search. Missing readings (NaN) go through the
+    same degradation policy as the controller.
+
+    Parameters:
+    - timestamps (numpy.ndarray): Sample times in seconds, ascending.
+    - series (dict): Readings keyed by temperature_ambient, temperature_cold and temperature_hot.
+    - engine (DecisionEngine): Supplies the thresholds, bands, dwells, trend and degradation settings.
+
+    Returns:
+    - tuple: (index into MODE_CODES of the mode in force at each sample, number of samples with a missing reading).
+    """
+    readings, minimum = degrade(timestamps, series, engine)
+
+    # Only readings taken at a sample have a trend worth projecting
+    slopes = trends(timestamps, {name: series[name] for name in DECISION_READINGS}, engine.trend_window)
+    projected = [values + np.maximum(0.0, slopes[name]) * engine.lookahead
+                 for name, values in zip(DECISION_READINGS, readings)]
+    rising = np.maximum(choose_modes(*projected, engine.thresholds), minimum)
+    # Step down no further than the rising trend allows
+    falling = np.maximum(rising, choose_modes(*readings, engine.lower_thresholds))
+
+    # Samples calling for a mode above, or below, each mode
+    above = [np.flatnonzero(rising > code) for code in range(len(MODE_CODES))]
+    below = [np.flatnonzero(falling < code) for code in range(len(MODE_CODES))]
+    dwell = [engine.min_dwell.get(mode, 0) for mode in MODE_CODES]
+
+    # The engine's first decision is unconstrained. The loop runs once per
+    # mode change, so it calls the arrays' own searchsorted() and keeps plain
+    # ints to stay clear of NumPy's per-call overhead.
+    count = len(timestamps)
+    changes, codes = [0], [int(rising[0])]
+    position, mode, since = 0, codes[0], float(timestamps[0])
+    while True:
+        candidates = above[mode]
+        index = int(candidates.searchsorted(position, side='right'))
+        step_up = int(candidates[index]) if index < len(candidates) else count
+
+        earliest = max(position + 1, int(timestamps.searchsorted(since + dwell[mode], side='left')))
+        candidates = below[mode]
+        index = int(candidates.searchsorted(earliest, side='left'))
+        step_down = int(candidates[index]) if index < len(candidates) else count
+
+        position = min(step_up, step_down)
+        if position >= count:
+            break
+        mode = int(rising[position] if position == step_up else falling[position])
+        since = float(timestamps[position])
+        changes.append(position)
+        codes.append(mode)
+
+    modes = np.repeat(np.asarray(codes, dtype=np.int8), np.diff(changes + [count]))
+    missing = np.any([np.isnan(series[name]) for name in DECISION_READINGS], axis=0)
+    return modes, int(np.count_nonzero(missing))
+
+def summarise(modes, missing, step):
+    """
+    Builds the replay report.
+
+    Returns:
+    - dict: Mode occupancy in seconds, AC runtime in seconds, mode transitions, AC starts and missing samples.
+    """
+    counts = np.bincount(modes, minlength=len(MODE_CODES))
+    ac_on = np.array([actions.MODES[mode]['ac_unit'] for mode in MODE_CODES])[modes]
+    return {
+        'occupancy': {mode: float(counts[code] * step) for code, mode in enumerate(MODE_CODES)},
+        'ac_runtime': float(np.count_nonzero(ac_on) * step),
+        'transitions': int(np.count_nonzero(modes[1:] != modes[:-1])),
+        'ac_starts': int(np.count_nonzero(ac_on[1:] & ~ac_on[:-1])),
+        'missing': missing,
+        'samples': len(modes),
+    }
+
+def print_report(report, duration, elapsed):
+    """Prints a replay report."""
+    print(f"Replayed {report['samples']} samples over {duration / 86400:.1f} days in {elapsed:.3f}s")
+    print("Mode occupancy:")
+    for mode, seconds in report['occupancy'].items():
+        print(f"  {mode:<18} {seconds / 3600:8.1f} h  {100 * seconds / duration:5.1f}%")
+    print(f"AC runtime:          {report['ac_runtime'] / 3600:.1f} h")
+    print(f"AC starts:           {report['ac_starts']}")
+    print(f"Mode transitions:    {report['transitions']}")
+    print(f"Missing samples:     {report['missing']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the Envirozen decision logic over historical readings.")
+    parser.add_argument('--days', type=float, default=7, help="days of history to replay (default 7)")
+    parser.add_argument('--end', type=float, help="end of the window as Unix seconds (default now)")
+    parser.add_argument('--step', type=float, help="seconds between samples (default evaluation_interval)")
+    parser.add_argument('--load', metavar='FILE', help="replay a .npz dump instead of querying Prometheus")
+    parser.add_argument('--save', metavar='FILE', help="save the queried readings to a .npz dump")
+    parser.add_argument('--min-ac-run-time', type=float, help="override MIN_AC_RUN_TIME in seconds")
+    parser.add_argument('--lookahead', type=float, help="override TREND_LOOKAHEAD in seconds")
+    parser.add_argument('--set', action='append', default=[], metavar='THRESHOLD=VALUE',
+                        help="override a METRIC_THRESHOLDS entry, e.g. --set temperature_cold=21")
+    parser.add_argument('--zone', help="zone to replay (default the first configured zone)")
+    args = parser.parse_args()
+
+    try:
+        zone = get_zone(args.zone)
+    except KeyError as e:
+        parser.error(str(e))
+
+    thresholds = dict(zone.thresholds or config.METRIC_THRESHOLDS)
+    for override in args.set:
+        name, _, value = override.partition('=')
+        if name not in thresholds:
+            parser.error(f"unknown threshold '{name}'")
+        thresholds[name] = float(value)
+    if args.min_ac_run_time is not None:
+        config.MIN_AC_RUN_TIME = args.min_ac_run_time
+    if args.lookahead is not None:
+        config.TREND_LOOKAHEAD = args.lookahead
+
+    if args.load:
+        timestamps, series = load_dump(args.load)
+    else:
+        step = args.step or config.evaluation_interval
+        end = args.end or time.time()
+        timestamps, series = load_prometheus(zone.queries, end - args.days * 86400, end, step)
+    if args.save:
+        save_dump(args.save, timestamps, series)
+
+    if len(timestamps) < 2:
+        parser.error("not enough samples to replay")
+    step = float(timestamps[1] - timestamps[0])
+
+    started = time.perf_counter()
+    modes, missing = replay(timestamps, series, create_engine(zone.store, thresholds))
+    report = summarise(modes, missing, step)
+    elapsed = time.perf_counter() - started
+
+    print_report(report, len(timestamps) * step, elapsed)
+
+if __name__ == "__main__":
+    main()
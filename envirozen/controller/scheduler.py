@@ -0,0 +1,82 @@
+import asyncio
+import syslog
+from logs import log
+
+class Scheduler:
+    """
+    Fixed-rate scheduler for the control loop.
+
+    Ticks are scheduled against absolute deadlines on the event loop's
+    monotonic clock, so the time a tick takes to run does not push the next one
+    back and the period does not drift. A tick that overruns its slot skips the
+    missed deadlines rather than firing them back to back.
+
+    wake() runs an extra tick straight away, for example when a mode change or
+    a new reading should not wait for the next scheduled tick. Out-of-band ticks
+    do not move the fixed-rate schedule.
+
+    Parameters:
+    - interval (float): Seconds between scheduled ticks.
+    - callback (coroutine function): Awaited once per tick.
+    """
+
+    def __init__(self, interval, callback):
+        self.interval = interval
+        self.callback = callback
+        self.ticks = 0            # Scheduled ticks run
+        self.wakeups = 0          # Out-of-band ticks run
+        self.overruns = 0         # Scheduled deadlines missed because a tick ran too long
+        self.last_jitter = 0.0    # Seconds between the last scheduled deadline and its tick starting
+        self.max_jitter = 0.0
+        self.last_duration = 0.0  # Seconds taken by the last tick
+        self._loop = None
+        self._wake_event = None
+
+    def wake(self):
+        """Requests an immediate out-of-band tick. Safe to call from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake_event.set)
+
+    async def run(self):
+        """Runs ticks forever."""
+        self._loop = asyncio.get_running_loop()
+        self._wake_event = asyncio.Event()
+        deadline = self._loop.time()
+
+        while True:
+            woken = await self._sleep_until(deadline)
+
+            start = self._loop.time()
+            if woken:
+                self.wakeups += 1
+            else:
+                self.ticks += 1
+                self.last_jitter = start - deadline
+                self.max_jitter = max(self.max_jitter, self.last_jitter)
+
+            await self.callback()
+            self.last_duration = self._loop.time() - start
+
+            # Advance to the next deadline that is still in the future. Deadlines
+            # that passed during an out-of-band tick are covered by that tick.
+            if not woken:
+                deadline += self.interval
+            now = self._loop.time()
+            if now > deadline:
+                missed = int((now - deadline) // self.interval) + 1
+                deadline += missed * self.interval
+                if not woken:
+                    self.overruns += missed
+                    log(syslog.LOG_WARNING, f"Control loop tick took {self.last_duration:.2f}s, skipped {missed} tick(s)", key='overrun', state=True)
+
+    async def _sleep_until(self, deadline):
+        """Sleeps until the deadline, returning True if woken early by wake()."""
+        timeout = deadline - self._loop.time()
+        if timeout <= 0:
+            return False
+        try:
+            await asyncio.wait_for(self._wake_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._wake_event.clear()
+        return True
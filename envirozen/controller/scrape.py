@@ -0,0 +1,128 @@
+import asyncio
+import re
+import logging
+from urllib.parse import urlsplit
+from prometheus import SELECTOR_PATTERN
+
+# Matches a sample line such as temperature{location="cold"} 21.5
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)(?:\s+(-?\d+))?\s*$')
+LABEL_PATTERN = re.compile(r'(\w+)\s*=\s*"((?:[^"\\]|\\.)*)"')
+
+def parse_exposition(text, timestamps=False):
+    """
+    Parses Prometheus text exposition format into samples.
+
+    Comment, HELP/TYPE and blank lines are skipped, as are lines that cannot be parsed.
+
+    Parameters:
+    - text (str): The body of a /metrics response.
+    - timestamps (bool): Also return each sample's timestamp.
+
+    Returns:
+    - list: Tuples of (metric name, labels dict, float value), with the
+      timestamp in seconds, or None where the sample has none, appended if timestamps is set.
+    """
+    samples = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = SAMPLE_PATTERN.match(line)
+        if not match:
+            continue
+        name, labels, value, timestamp = match.groups()
+        try:
+            value = float(value)
+        except ValueError:
+            continue
+        sample = (name, dict(LABEL_PATTERN.findall(labels or '')), value)
+        if timestamps:
+            sample += (None if timestamp is None else int(timestamp) / 1000,)
+        samples.append(sample)
+    return samples
+
+async def fetch_metrics(url, timeout):
+    """
+    Fetches the body of a sensor's /metrics endpoint.
+
+    The Pico W sensors speak plain HTTP/1.0 and close the connection after
+    each response, so a bare asyncio stream is all that is needed.
+
+    Parameters:
+    - url (str): Full URL of the metrics endpoint, e.g. http://192.168.88.50/metrics.
+    - timeout (float): Seconds allowed for the whole request.
+
+    Returns:
+    - str: The response body.
+
+    Raises:
+    - Exception: If the request fails, times out or returns a non-200 status.
+    """
+    parts = urlsplit(url)
+    host, port, path = parts.hostname, parts.port or 80, parts.path or '/metrics'
+
+    async def request():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write(f'GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n'.encode())
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    response = await asyncio.wait_for(request(), timeout)
+    head, _, body = response.partition(b'\r\n\r\n')
+    status_line = head.split(b'\r\n', 1)[0]
+    if status_line.split()[1:2] != [b'200']:
+        raise Exception(f"Unexpected response from {url}: {status_line.decode(errors='replace')}")
+    return body.decode(errors='replace')
+
+async def scrape_sensors(endpoints, timeout):
+    """
+    Scrapes every sensor endpoint concurrently.
+
+    Parameters:
+    - endpoints (list): URLs of the sensor metrics endpoints.
+    - timeout (float): Seconds allowed for each sensor.
+
+    Returns:
+    - list: Samples from every sensor that responded, as returned by parse_exposition().
+    """
+    results = await asyncio.gather(*(fetch_metrics(url, timeout) for url in endpoints), return_exceptions=True)
+
+    samples = []
+    for url, result in zip(endpoints, results):
+        if isinstance(result, Exception):
+            logging.error(f"Failed to scrape sensor {url}: {result!r}")
+            continue
+        samples.extend(parse_exposition(result))
+    return samples
+
+async def scrape_readings(queries, endpoints, timeout):
+    """
+    Resolves configured queries straight from the sensors, without Prometheus.
+
+    Only simple selectors such as temperature{location="cold"} can be answered
+    this way; any other query resolves to None.
+
+    Parameters:
+    - queries (dict): Mapping of metric names to Prometheus query strings, usually config.QUERIES.
+    - endpoints (list): URLs of the sensor metrics endpoints.
+    - timeout (float): Seconds allowed for each sensor.
+
+    Returns:
+    - dict: Mapping of metric names to float values, or None where no sensor reported a sample.
+    """
+    samples = await scrape_sensors(endpoints, timeout)
+
+    readings = {}
+    for metric_name, query in queries.items():
+        readings[metric_name] = None
+        match = SELECTOR_PATTERN.match(query or '')
+        if not match:
+            continue
+        metric, label, value = match.groups()
+        for name, labels, sample in samples:
+            if name == metric and labels.get(label) == value:
+                readings[metric_name] = sample
+    return readings
@@ -1,115 +1,278 @@
-from prometheus_api_client import PrometheusConnect
 import config as config
-from flask import Flask, render_template, redirect, url_for
+from aiohttp import web
+from jinja2 import Environment, FileSystemLoader
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 import actions
-import envirozen
-import RPi.GPIO as GPIO
+from mode import AUTOMATIC, MANUAL, EMERGENCY
+from commands import command_queue
+from ingest import sensor_ingest
+from zones import zones, get_zone
+import asyncio
+import json
 import os
 import syslog
+import time
 
-app = Flask(__name__)
-
-# Initialize Prometheus client using the URL from config
-prometheus_api = PrometheusConnect(url=config.PROMETHEUS_URL)
-STATUS_FILE = 'status.txt'
-
-@app.route('/')
-def display_temperature():
-    # Create an empty dictionary to store metric names and values
-    metric_values = {}
-
-    FAN_1_PIN = 22
-    FAN_2_PIN = 26
-    AC_PIN = 6
-    DAMPER_PIN = 4
-
-    # Read the state of PINs
-    ac_pin_state = GPIO.input(AC_PIN)
-    damper_pin_state = GPIO.input(DAMPER_PIN)
-    fan1_pin_state = GPIO.input(FAN_1_PIN)
-    fan2_pin_state = GPIO.input(FAN_2_PIN)
-
-    # Map GPIO states to human-readable strings
-    pin_state_mapping = {GPIO.HIGH: "ON", GPIO.LOW: "OFF"}
-    # AC PIN state mapping is reveresed as we want the default (power absent)
-    # to mean we run with AC. This protects against the controller power failing etc.
-    ac_pin_state_mapping = {GPIO.HIGH: "OFF", GPIO.LOW: "ON"} 
-
-    # Add PIN states to the metric_values dictionary
-    metric_values['ac_pin_state'] = ac_pin_state_mapping.get(ac_pin_state, "UNKNOWN")
-    metric_values['damper_pin_state'] = pin_state_mapping.get(damper_pin_state, "UNKNOWN")
-    metric_values['fan1_pin_state'] = pin_state_mapping.get(fan1_pin_state, "UNKNOWN")
-    metric_values['fan2_pin_state'] = pin_state_mapping.get(fan2_pin_state, "UNKNOWN")
-
-    # Iterate over all metric names and their corresponding queries
-    for metric_name, query in config.QUERIES.items():
-        # Query Prometheus for the metric data
-        result = prometheus_api.custom_query(query=query)
-
-        # Iterate over the result set from Prometheus
-        for entry in result:
-            # Extract the temperature value from the result entry
-            temperature = entry.get('value', [None, None])[1]
-
-            # Store the metric name and value in the dictionary
-            metric_values[metric_name] = temperature
-
-    # Render an HTML template with the metric values
-    return render_template('server.html', metric_values=metric_values)
-
-@app.route('/ac')
-def ac_on():
-    with open(STATUS_FILE, 'w') as file:
-        file.write('manual')  # Switch to manual mode
-    actions.ac_on_web()
-    syslog.syslog(syslog.LOG_INFO, "Manual AC Mode")
-    # Redirect back to the main page after the action is performed
-    return redirect(url_for('display_temperature'))
-
-@app.route('/freecooling')
-def freecooling():
-    with open(STATUS_FILE, 'w') as file:
-        file.write('manual')  # Switch to manual mode
-    actions.freecooling_web()
-    syslog.syslog(syslog.LOG_INFO, "Manual Freecooling Mode")
-    # Redirect back to the main page after the action is performed
-    return redirect(url_for('display_temperature'))
-
-@app.route('/freecooling_turbo')
-def freecooling_turbo():
-    with open(STATUS_FILE, 'w') as file:
-        file.write('manual')  # Switch to manual mode
-    actions.freecooling_turbo_web()
-    syslog.syslog(syslog.LOG_INFO, "Manual Freecooling Turbo Mode")
-    # Redirect back to the main page after the action is performed
-    return redirect(url_for('display_temperature'))
-
-@app.route('/passive')
-def passive_cooling_web():
-    with open(STATUS_FILE, 'w') as file:
-        file.write('manual')  # Switch to manual mode
-    actions.passive_cooling_web()
-    syslog.syslog(syslog.LOG_INFO, "Manual Passive Mode")
-    # Redirect back to the main page after the action is performed
-    return redirect(url_for('display_temperature'))
-
-@app.route('/emergency')
-def emergency():
-    with open(STATUS_FILE, 'w') as file:
-        file.write('emergency')  # Switch to emergency mode
-    actions.emergency_web()
-    syslog.syslog(syslog.LOG_INFO, "Emergency Mode - All on")
-    # Redirect back to the main page after the action is performed
-    return redirect(url_for('display_temperature'))
-
-@app.route('/auto')
-def auto():
-    with open(STATUS_FILE, 'w') as file:
-        file.write('automatic')  # Switch back to automatic mode
-    envirozen.evaluate_metrics()
-    syslog.syslog(syslog.LOG_INFO, "Automatic Mode")
-    # Redirect back to the main page after the action is performed
-    return redirect(url_for('display_temperature'))
-
-if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=5000)
+# The web server runs on the controller's event loop, so routes share the
+# control loop's GPIO setup, readings and mode state rather than copies of them
+routes = web.RouteTableDef()
+# The dashboard's rolling statistics cover the decision engine's trend window
+for zone in zones:
+    zone.store.track(config.TREND_WINDOW)
+    zone.store.track(config.TREND_WINDOW / 2)
+# Status events a slow subscriber can fall behind by before it starts missing the oldest
+SUBSCRIBER_BACKLOG = 16
+# Seconds between comments sent on an idle event stream
+EVENT_KEEPALIVE = 15
+templates = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates')), autoescape=True)
+
+def request_zone(request):
+    """Returns the zone named by the request's ?zone= parameter, or the first zone."""
+    try:
+        return get_zone(request.query.get('zone'))
+    except KeyError as e:
+        raise web.HTTPNotFound(text=str(e))
+
+def redirect_home(zone):
+    """Redirects back to the zone's page after an action."""
+    raise web.HTTPSeeOther('/' if zone is zones[0] else f'/?zone={zone.name}')
+
+def zone_status(zone, now):
+    """
+    Collects everything the dashboard shows for a zone.
+
+    Parameters:
+    - zone (Zone): The zone.
+    - now (float): Current time in seconds since the epoch.
+
+    Returns:
+    - dict: The zone's control mode, any command waiting to be applied, relay states, latest readings and their rolling statistics.
+    """
+    # Read the relay pins back from the hardware; actions handles the
+    # AC relay's reversed polarity, so True always means on (or open)
+    relays = zone.read_relays()
+
+    # The latest readings kept by the control loop; this never queries
+    # Prometheus, so the dashboard adds no load on the TSDB
+    readings = zone.store.latest(config.DASHBOARD_MAX_AGE, now)
+
+    # Rolling statistics over the decision engine's trend window
+    window = config.TREND_WINDOW
+    statistics = {}
+    for name in ('temperature_hot', 'temperature_cold', 'temperature_floor', 'temperature_ambient'):
+        if name in readings:
+            statistics[name] = {
+                'minimum': zone.store.minimum(name, window),
+                'maximum': zone.store.maximum(name, window),
+                'trend': zone.store.slope(name, window) * 3600,  # °C per hour
+            }
+
+    state = zone.mode_state.snapshot()
+    return {
+        'zone': zone.name,
+        'control': state['mode'],
+        'cooling': state['cooling'],
+        'pending': command_queue.pending(zone.name),
+        'mode': actions.decode_mode(relays),
+        'relays': relays,
+        'degraded': zone.engine.degraded,
+        'readings': readings,
+        'statistics': statistics,
+        'window': window,
+        'timestamp': now,
+    }
+
+class StatusFeed:
+    """
+    The latest status of every zone, pushed to subscribers when it changes.
+
+    The control loop calls publish() after every evaluation. Each zone's
+    status is collected once, compared with the last one sent, and only if
+    it changed is it encoded, once, and queued for every subscriber. Page
+    loads, /api/status and the event stream all read from here, so however
+    many browsers or scripts are watching, the pins are read and the
+    readings summarised once per tick.
+    """
+
+    def __init__(self):
+        self.status = {}        # Zone name: last published status
+        self.subscribers = {}   # Queue: zone name it follows, or None for every zone
+
+    def publish(self, now=None):
+        """Collects each zone's status and sends the ones that changed to subscribers."""
+        now = time.time() if now is None else now
+        for zone in zones:
+            status = zone_status(zone, now)
+            previous = self.status.get(zone.name)
+            self.status[zone.name] = status
+            if previous is not None and dict(previous, timestamp=now) == status:
+                continue
+            event = f"event: status\ndata: {json.dumps(status)}\n\n".encode()
+            for subscriber, name in self.subscribers.items():
+                if name in (None, zone.name):
+                    if subscriber.full():
+                        subscriber.get_nowait()  # A slow client misses the oldest update, not the newest
+                    subscriber.put_nowait(event)
+
+    def current(self, zone):
+        """Returns the zone's last published status, collecting it if nothing has been published yet."""
+        if zone.name not in self.status:
+            self.status[zone.name] = zone_status(zone, time.time())
+        return self.status[zone.name]
+
+    def subscribe(self, name=None):
+        """
+        Starts queueing status events for a zone, or for every zone.
+
+        Returns:
+        - asyncio.Queue: Encoded server-sent events. Pass it to unsubscribe() when done.
+        """
+        subscriber = asyncio.Queue(maxsize=SUBSCRIBER_BACKLOG)
+        self.subscribers[subscriber] = name
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.pop(subscriber, None)
+
+# Status of every zone, published by the control loop after each evaluation
+feed = StatusFeed()
+
+@routes.get('/')
+async def display_temperature(request):
+    zone = request_zone(request)
+    status = feed.current(zone)
+
+    # Render an HTML template with the zone's status; it then follows /api/events for updates
+    html = templates.get_template('server.html').render(
+        status=status, window_minutes=status['window'] / 60, emergency_mode=status['control'] == EMERGENCY,
+        zone=zone.name, zones=[zone.name for zone in zones])
+    return web.Response(text=html, content_type='text/html')
+
+@routes.get('/api/status')
+async def api_status(request):
+    # One zone with ?zone=, otherwise every zone keyed by name
+    if 'zone' in request.query:
+        return web.json_response(feed.current(request_zone(request)))
+    return web.json_response({'zones': {zone.name: feed.current(zone) for zone in zones}})
+
+@routes.get('/api/events')
+async def api_events(request):
+    # Server-sent events: the current status straight away, then each change as it is published
+    name = request_zone(request).name if 'zone' in request.query else None
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+
+    subscriber = feed.subscribe(name)
+    try:
+        for zone in zones:
+            if name in (None, zone.name):
+                await response.write(f"event: status\ndata: {json.dumps(feed.current(zone))}\n\n".encode())
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.get(), EVENT_KEEPALIVE)
+            except asyncio.TimeoutError:
+                event = b": keepalive\n\n"  # Keeps proxies from closing an idle stream
+            await response.write(event)
+    except ConnectionResetError:
+        # The client went away; a cancellation (e.g. at shutdown) propagates once it is unsubscribed
+        pass
+    finally:
+        feed.unsubscribe(subscriber)
+    return response
+
+@routes.get('/metrics')
+async def controller_metrics(request):
+    # The controller's own metrics: loop latency, mode and error counts
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+def queue_command(request, control, cooling=None):
+    """
+    Queues a mode change from a dashboard button and redirects back to the zone's page.
+
+    The control loop applies the command on its next tick, which this wakes;
+    nothing is actuated inside the request, and a burst of presses only
+    applies the last one.
+    """
+    zone = request_zone(request)
+    command_queue.submit(zone.name, control, cooling)
+    zone.log(syslog.LOG_INFO, f"{control.capitalize()} mode requested" + (f" ({cooling})" if control == MANUAL else ""))
+    redirect_home(zone)
+
+@routes.post('/ac')
+async def ac_on(request):
+    queue_command(request, MANUAL, 'ac')
+
+@routes.post('/freecooling')
+async def freecooling(request):
+    queue_command(request, MANUAL, 'freecooling')
+
+@routes.post('/freecooling_turbo')
+async def freecooling_turbo(request):
+    queue_command(request, MANUAL, 'freecooling_turbo')
+
+@routes.post('/passive')
+async def passive_cooling_web(request):
+    queue_command(request, MANUAL, 'passive')
+
+@routes.post('/emergency')
+async def emergency(request):
+    queue_command(request, EMERGENCY)
+
+@routes.post('/auto')
+async def auto(request):
+    queue_command(request, AUTOMATIC)
+
+@routes.post('/api/mode')
+async def api_mode(request):
+    # Queue a mode change for scripts and answer straight away, before it is applied
+    if request.content_type == 'application/json':
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Request body is not valid JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="Request body must be a JSON object")
+    else:
+        body = await request.post()
+
+    try:
+        zone = get_zone(body.get('zone', request.query.get('zone')))
+    except KeyError as e:
+        raise web.HTTPNotFound(text=str(e))
+    try:
+        pending = command_queue.submit(zone.name, body.get('mode'), body.get('cooling'))
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    zone.log(syslog.LOG_INFO, f"Mode change requested: {pending['mode']}" + (f" ({pending['cooling']})" if pending['mode'] == MANUAL else ""))
+    return web.json_response({'zone': zone.name, 'pending': pending}, status=202)
+
+@routes.post('/api/ingest')
+async def api_ingest(request):
+    # Readings a sensor buffered, as timestamped text exposition; the control loop merges them on its next tick,
+    # or straight away if one crosses a threshold
+    accepted = sensor_ingest.submit(await request.text(), time.time(), zones)
+    if not accepted:
+        raise web.HTTPBadRequest(text="No samples found in the request body")
+    return web.json_response({'accepted': accepted}, status=202)
+
+def create_app():
+    """Build the dashboard application."""
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+async def start_server(host, port):
+    """
+    Start the dashboard on the running event loop.
+
+    Parameters:
+    - host (str): Address to listen on.
+    - port (int): Port to listen on.
+
+    Returns:
+    - web.AppRunner: The runner, for cleanup on shutdown.
+    """
+    runner = web.AppRunner(create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
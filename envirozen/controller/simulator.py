@@ -0,0 +1,241 @@
+import argparse
+import math
+import random
+import logging
+import config as config
+
+# The simulator drives the real control code, so the relays must be fake
+# before actions is imported
+config.GPIO_BACKEND = 'fake'
+
+import actions
+from decision import DECISION_READINGS
+from prometheus import SELECTOR_PATTERN
+from zones import zones, get_zone
+
+CP_AIR = 1.005  # Specific heat of air, kJ/(kg.K)
+
+class ThermalModel:
+    """
+    Lumped thermal model of the server room.
+
+    The cold aisle is treated as a single thermal mass heated by the IT load
+    and cooled by outside air drawn through the damper, conduction through the
+    building envelope and, when it is on, the AC. The hot aisle sits a fixed
+    rise above the cold aisle, set by the IT load and the airflow through the
+    racks. Ambient follows a daily sine wave.
+
+    Parameters:
+    - it_load (float): Heat from the IT equipment, kW.
+    - ambient_mean (float): Mean outdoor temperature, °C.
+    - ambient_swing (float): Amplitude of the daily outdoor temperature swing, °C.
+    - capacity (float): Thermal capacity of the room, kJ/K.
+    - fan_flow (float): Outside air moved by each fan with the damper open, kg/s.
+    - passive_flow (float): Outside air moved with the damper open and fans off, kg/s.
+    - envelope_ua (float): Heat loss through the building envelope, kW/K.
+    - rack_flow (float): Air moved through the racks by the servers' own fans, kg/s.
+    - ac_capacity (float): Cooling capacity of the AC, kW.
+    - ac_setpoint (float): Cold aisle temperature the AC's own thermostat holds, °C.
+    - ac_cop (float): AC coefficient of performance, cooling kW per electrical kW.
+    - fan_power (float): Electrical power of each fan, kW.
+    - noise (float): Standard deviation of sensor noise, °C.
+    - seed (int): Seed for the sensor noise.
+    """
+
+    def __init__(self, it_load=5.0, ambient_mean=12.0, ambient_swing=6.0, capacity=400.0,
+                 fan_flow=1.0, passive_flow=0.1, envelope_ua=0.05, rack_flow=0.6,
+                 ac_capacity=8.0, ac_setpoint=18.0, ac_cop=3.0, fan_power=1.5,
+                 noise=0.1, seed=0):
+        self.it_load = it_load
+        self.ambient_mean = ambient_mean
+        self.ambient_swing = ambient_swing
+        self.capacity = capacity
+        self.fan_flow = fan_flow
+        self.passive_flow = passive_flow
+        self.envelope_ua = envelope_ua
+        self.rack_flow = rack_flow
+        self.ac_capacity = ac_capacity
+        self.ac_setpoint = ac_setpoint
+        self.ac_cop = ac_cop
+        self.fan_power = fan_power
+        self.noise = noise
+        self.random = random.Random(seed)
+
+        self.cold = ambient_mean + 8  # Cold aisle temperature, °C
+        self.ac_load = 0.0            # Heat the AC removed in the last step, kW
+
+    def ambient(self, t):
+        """Outdoor temperature at t seconds, warmest mid-afternoon."""
+        return self.ambient_mean + self.ambient_swing * math.sin(2 * math.pi * (t / 86400 - 0.375))
+
+    def hot(self):
+        """Hot aisle temperature: the cold aisle plus the rise across the racks."""
+        return self.cold + self.it_load / (CP_AIR * self.rack_flow)
+
+    def step(self, t, dt, relays):
+        """
+        Advances the model by one time step.
+
+        Parameters:
+        - t (float): Simulated time at the start of the step, seconds.
+        - dt (float): Length of the step, seconds.
+        - relays (dict): Relay states, as returned by actions.read_relays().
+        """
+        ambient = self.ambient(t)
+
+        outside_flow = 0.0
+        if relays['damper']:
+            fans = relays['fan_1'] + relays['fan_2']
+            outside_flow = fans * self.fan_flow if fans else self.passive_flow
+
+        gain = self.it_load - (outside_flow * CP_AIR + self.envelope_ua) * (self.cold - ambient)
+
+        # The AC runs flat out above its setpoint and just holds it below
+        self.ac_load = 0.0
+        if relays['ac_unit']:
+            if self.cold > self.ac_setpoint:
+                self.ac_load = self.ac_capacity
+            else:
+                self.ac_load = min(self.ac_capacity, max(0.0, gain))
+
+        self.cold += dt * (gain - self.ac_load) / self.capacity
+
+    def power(self, relays):
+        """Electrical power drawn by the cooling equipment, kW."""
+        fans = relays['fan_1'] + relays['fan_2']
+        return fans * self.fan_power + self.ac_load / self.ac_cop
+
+    def readings(self, t):
+        """Noisy sensor readings by location."""
+        noise = lambda: self.random.gauss(0, self.noise)
+        return {
+            'ambient': self.ambient(t) + noise(),
+            'cold': self.cold + noise(),
+            'hot': self.hot() + noise(),
+            'floor': self.cold - 1 + noise(),
+        }
+
+def location_queries(queries):
+    """Maps each query name to the sensor location it selects."""
+    locations = {}
+    for name, query in queries.items():
+        match = SELECTOR_PATTERN.match(query)
+        if match and match.group(2) == 'location':
+            locations[name] = match.group(3)
+    return locations
+
+def simulate(model, duration, step=None, start=0.0, zone=None):
+    """
+    Runs a zone's control logic against the thermal model faster than real time.
+
+    Each step the model's sensor readings are fed into the zone's readings
+    store and decision engine, the relays it sets are read back from the fake
+    GPIO backend, and the model advances with those relays. The per-tick
+    metrics, logging and operator overrides of Zone.evaluate() are skipped, and
+    the relays are only driven when the decided mode changes, so a 30 day run
+    takes a few seconds. Syslog output is masked for the duration.
+
+    Parameters:
+    - model (ThermalModel): The room to simulate.
+    - duration (float): Simulated seconds to run for.
+    - step (float): Seconds per evaluation, defaults to config.evaluation_interval.
+    - start (float): Simulated start time, seconds since midnight on day one.
+    - zone (Zone): The zone to simulate, defaults to the first configured zone.
+
+    Returns:
+    - dict: Mode occupancy in seconds, transitions, relay actuations, energy in kWh and temperature extremes.
+    """
+    step = step or config.evaluation_interval
+    zone = zone or zones[0]
+    # Only the readings the decision rules use need storing
+    locations = {name: location for name, location in location_queries(zone.queries).items() if name in DECISION_READINGS}
+
+    # Start from the controller's safe state
+    zone.reset()
+    zone.set_mode('ac')
+    relays = zone.read_relays()
+    mode = actions.decode_mode(relays) or 'unknown'
+    actuations_before = dict(zone.relays.actuations)
+
+    occupancy = {mode: 0.0 for mode in actions.MODES}
+    report = {'occupancy': occupancy, 'transitions': 0, 'energy_kwh': 0.0, 'ac_kwh': 0.0,
+              'max_cold': -math.inf, 'max_hot': -math.inf, 'min_cold': math.inf}
+
+    logging.disable(logging.CRITICAL)
+    try:
+        previous_mode = mode
+        t = start
+        while t < start + duration:
+            by_location = model.readings(t)
+            readings = {name: by_location.get(location) for name, location in locations.items()}
+            zone.store.append(readings, t)
+            decided, _, _ = zone.engine.decide(readings, t)
+            if decided != zone.current_mode:
+                zone.set_mode(decided, t)
+                relays = zone.read_relays()
+                mode = actions.decode_mode(relays) or 'unknown'
+                if mode != previous_mode:
+                    report['transitions'] += 1
+                    previous_mode = mode
+
+            model.step(t, step, relays)
+
+            occupancy[mode] = occupancy.get(mode, 0.0) + step
+            report['energy_kwh'] += model.power(relays) * step / 3600
+            report['ac_kwh'] += model.ac_load / model.ac_cop * step / 3600
+            report['max_cold'] = max(report['max_cold'], model.cold)
+            report['min_cold'] = min(report['min_cold'], model.cold)
+            report['max_hot'] = max(report['max_hot'], model.hot())
+            t += step
+    finally:
+        logging.disable(logging.NOTSET)
+
+    report['actuations'] = {relay: count - actuations_before[relay] for relay, count in zone.relays.actuations.items()}
+    return report
+
+def print_report(report, duration):
+    """Prints a simulation report."""
+    print(f"Simulated {duration / 86400:.1f} days")
+    print("Mode occupancy:")
+    for mode, seconds in report['occupancy'].items():
+        print(f"  {mode:<18} {seconds / 3600:8.1f} h  {100 * seconds / duration:5.1f}%")
+    print(f"Mode transitions:    {report['transitions']}")
+    print("Relay actuations:    " + ", ".join(f"{relay} {count}" for relay, count in report['actuations'].items()))
+    print(f"Cooling energy:      {report['energy_kwh']:.1f} kWh (AC {report['ac_kwh']:.1f} kWh)")
+    print(f"Cold aisle range:    {report['min_cold']:.1f} to {report['max_cold']:.1f} °C")
+    print(f"Hottest hot aisle:   {report['max_hot']:.1f} °C")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Envirozen control logic against a simulated room.")
+    parser.add_argument('--days', type=float, default=30, help="simulated days to run (default 30)")
+    parser.add_argument('--step', type=float, help="seconds per evaluation (default evaluation_interval)")
+    parser.add_argument('--it-load', type=float, default=5.0, help="IT heat load in kW (default 5)")
+    parser.add_argument('--ambient-mean', type=float, default=12.0, help="mean outdoor temperature (default 12)")
+    parser.add_argument('--ambient-swing', type=float, default=6.0, help="daily outdoor swing (default 6)")
+    parser.add_argument('--min-ac-run-time', type=float, help="override MIN_AC_RUN_TIME in seconds")
+    parser.add_argument('--seed', type=int, default=0, help="seed for sensor noise")
+    parser.add_argument('--zone', help="zone to simulate (default the first configured zone)")
+    parser.add_argument('--set', action='append', default=[], metavar='THRESHOLD=VALUE',
+                        help="override a METRIC_THRESHOLDS entry, e.g. --set temperature_cold=21")
+    args = parser.parse_args()
+
+    config.METRIC_THRESHOLDS = dict(config.METRIC_THRESHOLDS)
+    for override in args.set:
+        name, _, value = override.partition('=')
+        if name not in config.METRIC_THRESHOLDS:
+            parser.error(f"unknown threshold '{name}'")
+        config.METRIC_THRESHOLDS[name] = float(value)
+    if args.min_ac_run_time is not None:
+        config.MIN_AC_RUN_TIME = args.min_ac_run_time
+
+    model = ThermalModel(it_load=args.it_load, ambient_mean=args.ambient_mean,
+                         ambient_swing=args.ambient_swing, seed=args.seed)
+    duration = args.days * 86400
+    try:
+        zone = get_zone(args.zone)
+    except KeyError as e:
+        parser.error(str(e))
+    print_report(simulate(model, duration, args.step, zone=zone), duration)
+
+if __name__ == "__main__":
+    main()
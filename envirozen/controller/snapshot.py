@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+import logging
+import config as config
+
+class StateSnapshot:
+    """
+    Checkpoint of the controller's in-memory state, for warm restarts.
+
+    After every evaluation the control loop saves each zone's cooling mode,
+    decision engine state (including when it entered the mode, which the
+    minimum dwell and AC run time count from) and the readings in its trend
+    window. On startup a recent snapshot lets the controller pick up where it
+    left off instead of forcing the AC on and waiting for Prometheus, so an
+    upgrade or crash costs no AC cycle. A snapshot older than max_age is
+    ignored and the controller cold starts as before.
+
+    The file lives on tmpfs by default, so it survives a service restart but
+    not a reboot, checkpointing never touches the SD card, and it is replaced
+    atomically so a crash mid-write leaves the previous checkpoint intact.
+
+    Parameters:
+    - path (str): Location of the snapshot file.
+    - max_age (float): Oldest snapshot, in seconds, to resume from.
+    """
+
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+
+    def save(self, zones, now):
+        """
+        Writes a checkpoint of every zone that has been driven into a mode.
+
+        Parameters:
+        - zones (list): The controller's zones.
+        - now (float): Current time in seconds since the epoch.
+        """
+        states = {zone.name: zone.snapshot(now) for zone in zones if zone.current_mode is not None}
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.state-')
+            with os.fdopen(fd, 'w') as file:
+                json.dump({'timestamp': now, 'zones': states}, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Failed to save state snapshot to {self.path}: {e}")
+
+    def load(self, now):
+        """
+        Reads the last checkpoint back if it is recent enough to resume from.
+
+        Parameters:
+        - now (float): Current time in seconds since the epoch.
+
+        Returns:
+        - tuple: (age in seconds, {zone name: state}), or None if there is no usable snapshot.
+        """
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            age = now - data['timestamp']
+            states = data['zones']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if not 0 <= age <= self.max_age:
+            return None
+        return age, states
+
+# Checkpoint of the control loop's state, saved every evaluation
+state_snapshot = StateSnapshot(config.STATE_SNAPSHOT_FILE, config.STATE_SNAPSHOT_MAX_AGE)
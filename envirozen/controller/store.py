@@ -0,0 +1,386 @@
+from array import array
+from bisect import bisect_left
+from collections import deque
+import config as config
+
+class RollingWindow:
+    """
+    Running statistics over the samples of a SeriesBuffer from the last length seconds.
+
+    Each append adds the new sample and evicts the ones that have fallen out
+    of the window, updating running sums for the mean and monotonic queues
+    for the minimum and maximum, so every statistic costs O(1) amortised.
+
+    Parameters:
+    - length (float): Seconds covered by the window.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.clear()
+
+    def clear(self):
+        """Forgets every sample."""
+        self.start = 0      # Sequence number of the oldest sample in the window
+        self.count = 0
+        self.sum_time = 0.0
+        self.sum_value = 0.0
+        self._minimum = deque()  # (sequence number, value), values increasing
+        self._maximum = deque()  # (sequence number, value), values decreasing
+
+    def add(self, sequence, offset, value):
+        """Adds the sample with the given sequence number, time offset and value."""
+        self.count += 1
+        self.sum_time += offset
+        self.sum_value += value
+        while self._minimum and self._minimum[-1][1] >= value:
+            self._minimum.pop()
+        self._minimum.append((sequence, value))
+        while self._maximum and self._maximum[-1][1] <= value:
+            self._maximum.pop()
+        self._maximum.append((sequence, value))
+
+    def evict(self, offset, value):
+        """Removes the oldest sample, whose time offset and value are given."""
+        self.count -= 1
+        self.sum_time -= offset
+        self.sum_value -= value
+        if self._minimum[0][0] == self.start:
+            self._minimum.popleft()
+        if self._maximum[0][0] == self.start:
+            self._maximum.popleft()
+        self.start += 1
+
+    def minimum(self):
+        """Returns the lowest value in the window, or None if it is empty."""
+        return self._minimum[0][1] if self.count else None
+
+    def maximum(self):
+        """Returns the highest value in the window, or None if it is empty."""
+        return self._maximum[0][1] if self.count else None
+
+class SeriesBuffer:
+    """
+    Fixed-size ring buffer of (time, value) samples for one sensor location.
+
+    Samples live in two preallocated arrays of doubles, so the buffer never
+    grows and holds no per-sample objects. When it is full the oldest sample
+    is overwritten. Windows registered with track() are kept up to date on
+    every append.
+
+    Parameters:
+    - capacity (int): Number of samples kept.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.windows = {}
+        self.clear()
+
+    def clear(self):
+        """Forgets every sample."""
+        self.next = 0      # Sequence number the next sample will get
+        self.origin = None  # Time of the first sample; times in windows are offsets from it
+        for window in self.windows.values():
+            window.clear()
+
+    def __len__(self):
+        return min(self.next, self.capacity)
+
+    def track(self, length):
+        """
+        Starts keeping running statistics over the last length seconds.
+
+        Samples already stored within length seconds of the newest fill the
+        window straight away, so a window tracked after a warm restore covers
+        the restored readings.
+
+        Returns:
+        - RollingWindow: The window, shared with any earlier caller asking for the same length.
+        """
+        if length not in self.windows:
+            window = RollingWindow(length)
+            window.start = self.next - len(self)
+            if self.next:
+                newest = self.times[(self.next - 1) % self.capacity]
+                while window.start < self.next and self.times[window.start % self.capacity] <= newest - length:
+                    window.start += 1
+            self.windows[length] = window
+            for sequence in range(window.start, self.next):
+                self._add(window, sequence)
+        return self.windows[length]
+
+    def append(self, timestamp, value):
+        """
+        Adds a sample. Samples must be appended in time order.
+
+        Parameters:
+        - timestamp (float): Time of the sample, seconds.
+        - value (float): The reading.
+        """
+        if self.origin is None:
+            self.origin = timestamp
+
+        # Make room, dropping the oldest sample from any window still holding it
+        if self.next >= self.capacity:
+            dropped = self.next - self.capacity
+            for window in self.windows.values():
+                if window.start == dropped:
+                    self._evict(window)
+
+        slot = self.next % self.capacity
+        self.times[slot] = timestamp
+        self.values[slot] = value
+        sequence = self.next
+        self.next += 1
+
+        offset = timestamp - self.origin
+        for window in self.windows.values():
+            window.add(sequence, offset, value)
+            while window.start < self.next and self.times[window.start % self.capacity] <= timestamp - window.length:
+                self._evict(window)
+
+    def merge(self, points, spacing=0):
+        """
+        Fills gaps in the buffer with samples that may be older than the newest.
+
+        Points within spacing seconds of a sample already stored, or older
+        than everything a full buffer holds, are skipped. Points newer than
+        everything stored are appended; any others mean rebuilding the buffer
+        in time order, which costs O(capacity).
+
+        Parameters:
+        - points (list): (time, value) pairs, in any order.
+        - spacing (float): Seconds either side of a stored sample that count as covered.
+
+        Returns:
+        - int: Number of samples added.
+        """
+        stored = self.samples()
+        times = [timestamp for timestamp, _ in stored]
+        new = {}
+        for timestamp, value in points:
+            if len(stored) == self.capacity and timestamp < times[0]:
+                continue
+            index = bisect_left(times, timestamp - spacing)
+            if index < len(times) and times[index] <= timestamp + spacing:
+                continue
+            new[timestamp] = value
+        if not new:
+            return 0
+
+        if not times or min(new) > times[-1]:
+            for timestamp in sorted(new):
+                self.append(timestamp, new[timestamp])
+        else:
+            merged = sorted(stored + list(new.items()))[-self.capacity:]
+            self.clear()
+            for timestamp, value in merged:
+                self.append(timestamp, value)
+        return len(new)
+
+    def latest(self):
+        """Returns the newest (time, value) sample, or None if there are none."""
+        if not self.next:
+            return None
+        slot = (self.next - 1) % self.capacity
+        return self.times[slot], self.values[slot]
+
+    def samples(self):
+        """Returns every stored (time, value) sample, oldest first."""
+        return [(self.times[sequence % self.capacity], self.values[sequence % self.capacity])
+                for sequence in range(self.next - len(self), self.next)]
+
+    def _add(self, window, sequence):
+        slot = sequence % self.capacity
+        window.add(sequence, self.times[slot] - self.origin, self.values[slot])
+
+    def _evict(self, window):
+        slot = window.start % self.capacity
+        window.evict(self.times[slot] - self.origin, self.values[slot])
+
+class TimeSeriesStore:
+    """
+    The controller's memory of recent readings.
+
+    Holds one SeriesBuffer per distinct query, so names that share a sensor,
+    such as temperature_cold and temperature_cold_warning, share its history.
+    The control loop appends every set of readings it fetches; the decision
+    engine and the dashboard read windowed statistics back without another
+    round-trip to Prometheus or the sensors.
+
+    Windowed statistics are only available for windows registered with
+    track(), which keeps them O(1) whatever the retention.
+
+    Parameters:
+    - queries (dict): Mapping of metric names to query strings, usually config.QUERIES.
+    - retention (float): Seconds of history to keep.
+    - interval (float): Expected seconds between samples, used to size the buffers.
+    """
+
+    def __init__(self, queries, retention, interval):
+        self.capacity = int(retention // interval) + 1
+        self.interval = interval
+        self.queries = {}
+        self.buffers = {}
+        self.reconfigure(queries)
+
+    def reconfigure(self, queries):
+        """
+        Switches to a new set of queries.
+
+        Queries that were already stored keep their history, whatever name
+        they are now under; new ones start empty, with the same windows tracked.
+
+        Parameters:
+        - queries (dict): Mapping of metric names to query strings.
+        """
+        by_query = self._by_query()
+        lengths = {length for buffer in by_query.values() for length in buffer.windows}
+        self.queries = dict(queries)
+        self.buffers = {}
+        for name, query in queries.items():
+            if query not in by_query:
+                by_query[query] = SeriesBuffer(self.capacity)
+                for length in lengths:
+                    by_query[query].track(length)
+            self.buffers[name] = by_query[query]
+
+    def clear(self):
+        """Forgets every sample, keeping the tracked windows."""
+        for buffer in set(self.buffers.values()):
+            buffer.clear()
+
+    def track(self, length):
+        """Starts keeping statistics over the last length seconds for every series."""
+        for buffer in set(self.buffers.values()):
+            buffer.track(length)
+
+    def append(self, readings, timestamp):
+        """
+        Records a set of readings. Missing (None) readings are skipped.
+
+        Parameters:
+        - readings (dict): Mapping of metric names to values.
+        - timestamp (float): When the readings were taken, seconds.
+        """
+        seen = set()
+        for name, value in readings.items():
+            buffer = self.buffers.get(name)
+            if buffer is None or value is None or id(buffer) in seen:
+                continue
+            seen.add(id(buffer))
+            buffer.append(timestamp, value)
+
+    def latest(self, max_age=None, now=None):
+        """
+        Returns the newest value of every series.
+
+        Parameters:
+        - max_age (float): Leave out values older than this many seconds.
+        - now (float): Current time, seconds. Required with max_age.
+
+        Returns:
+        - dict: Mapping of metric names to values.
+        """
+        values = {}
+        for name, buffer in self.buffers.items():
+            sample = buffer.latest()
+            if sample is not None and (max_age is None or now - sample[0] <= max_age):
+                values[name] = sample[1]
+        return values
+
+    def dump(self, since):
+        """
+        Returns the samples newer than since, e.g. for a state snapshot.
+
+        Returns:
+        - dict: Mapping of query strings to lists of [time, value] pairs, oldest first.
+        """
+        return {query: [[timestamp, value] for timestamp, value in buffer.samples() if timestamp > since]
+                for query, buffer in self._by_query().items()}
+
+    def load(self, samples):
+        """
+        Appends samples returned by dump(), skipping any no newer than what is already stored.
+
+        Parameters:
+        - samples (dict): Mapping of query strings to lists of [time, value] pairs, oldest first.
+        """
+        by_query = self._by_query()
+        for query, points in samples.items():
+            buffer = by_query.get(query)
+            if buffer is None:
+                continue
+            for timestamp, value in points:
+                latest = buffer.latest()
+                if latest is None or timestamp > latest[0]:
+                    buffer.append(timestamp, value)
+
+    def merge(self, samples):
+        """
+        Backfills samples from another source, such as readings a sensor pushed after an outage.
+
+        Only samples that fall in a gap of at least the expected interval
+        between stored samples are added; the rest are already covered.
+
+        Parameters:
+        - samples (dict): Mapping of query strings to lists of (time, value) pairs, in any order.
+
+        Returns:
+        - int: Number of samples added.
+        """
+        by_query = self._by_query()
+        return sum(by_query[query].merge(points, self.interval / 2) for query, points in samples.items() if query in by_query)
+
+    def last_time(self, name):
+        """Returns the time of the newest sample of a series, or None if there is none."""
+        sample = self.buffers[name].latest()
+        return None if sample is None else sample[0]
+
+    def mean(self, name, length):
+        """Returns the mean of a series over the last length seconds, or None if it has no samples there."""
+        window = self._window(name, length)
+        return window.sum_value / window.count if window.count else None
+
+    def minimum(self, name, length):
+        """Returns the lowest value of a series over the last length seconds, or None if it has no samples there."""
+        return self._window(name, length).minimum()
+
+    def maximum(self, name, length):
+        """Returns the highest value of a series over the last length seconds, or None if it has no samples there."""
+        return self._window(name, length).maximum()
+
+    def slope(self, name, length):
+        """
+        Returns the trend of a series over the last length seconds in °C per second.
+
+        The trend is the difference between the means of the newer and older
+        halves of the window divided by the time between them. Both length
+        and length / 2 must be tracked.
+
+        Returns:
+        - float: The trend, or 0.0 until both halves of the window hold a sample.
+        """
+        whole = self._window(name, length)
+        newer = self._window(name, length / 2)
+        older_count = whole.count - newer.count
+        if not older_count or not newer.count:
+            return 0.0
+        older_mean = (whole.sum_value - newer.sum_value) / older_count
+        older_time = (whole.sum_time - newer.sum_time) / older_count
+        return (newer.sum_value / newer.count - older_mean) / (newer.sum_time / newer.count - older_time)
+
+    def _by_query(self):
+        return {self.queries[name]: buffer for name, buffer in self.buffers.items()}
+
+    def _window(self, name, length):
+        window = self.buffers[name].windows.get(length)
+        if window is None:
+            raise ValueError(f"No {length}s window is tracked; call track({length}) first")
+        return window
+
+# Recent readings, filled by the control loop and read by the decision engine and the dashboard
+readings_store = TimeSeriesStore(config.QUERIES, config.SERIES_RETENTION, config.evaluation_interval)
@@ -0,0 +1,262 @@
+import os
+import time
+import syslog
+from logs import log
+import config as config
+import actions
+import metrics
+from decision import DECISION_READINGS, create_engine
+from mode import ModeState, mode_state, AUTOMATIC
+from store import TimeSeriesStore, readings_store
+
+# Name of the single zone built from QUERIES, METRIC_THRESHOLDS and GPIO_PINS when ZONES is empty
+DEFAULT_ZONE = 'default'
+
+class Zone:
+    """
+    One room under control.
+
+    Each zone has its own sensors, thresholds, relays, readings store,
+    decision engine and control mode, so rooms are decided and overridden
+    independently while sharing one process, one GPIO backend and one
+    batched query per tick.
+
+    Parameters:
+    - name (str): Name of the zone, used in metrics, logs and the dashboard.
+    - queries (dict): Mapping of metric names to query strings, as config.QUERIES.
+    - thresholds (dict): The zone's thresholds, or None to follow config.METRIC_THRESHOLDS.
+    - relays (actions.RelayBank): The zone's relays.
+    - store (TimeSeriesStore): Recent readings for the zone.
+    - mode_state (ModeState): The zone's control mode.
+    """
+
+    def __init__(self, name, queries, thresholds, relays, store, mode_state):
+        self.name = name
+        self.queries = queries
+        self.thresholds = thresholds
+        self.relays = relays
+        self.store = store
+        self.mode_state = mode_state
+        self.engine = create_engine(store, thresholds)
+        self.current_mode = None  # Cooling mode the relays were last driven into
+        self.changed_at = None    # When the relays last changed mode, in seconds since the epoch
+
+    def reset(self):
+        """Forgets the zone's readings and decisions, e.g. before a simulation run."""
+        self.store.clear()
+        self.engine = create_engine(self.store, self.thresholds)
+        self.relays.invalidate()
+
+    def reconfigure(self, queries, thresholds):
+        """
+        Switches the zone to new queries and thresholds, keeping its readings, mode and dwell.
+
+        Parameters:
+        - queries (dict): Mapping of metric names to query strings.
+        - thresholds (dict): The zone's thresholds, or None to follow config.METRIC_THRESHOLDS.
+        """
+        self.queries = queries
+        self.thresholds = thresholds
+        self.store.reconfigure(queries)
+        engine = create_engine(self.store, thresholds)
+        engine.resume(self.engine)
+        self.engine = engine
+
+    def snapshot(self, now):
+        """
+        Returns the zone's mode, decision engine state and trend window readings, for a state snapshot.
+
+        Parameters:
+        - now (float): Current time in seconds since the epoch.
+        """
+        return {
+            'mode': self.current_mode,
+            'engine': self.engine.snapshot(),
+            'readings': self.store.dump(now - config.TREND_WINDOW),
+        }
+
+    def restore(self, state):
+        """
+        Picks up from a state returned by snapshot(), driving the relays straight into its mode.
+
+        Parameters:
+        - state (dict): As returned by snapshot().
+        """
+        self.store.load(state['readings'])
+        self.engine.restore(state['engine'])
+        self.set_mode(state['mode'])
+
+    def set_mode(self, mode, now=None):
+        """
+        Drives the zone's relays into a cooling mode and records it.
+
+        Parameters:
+        - mode (str): The cooling mode.
+        - now (float): Current time in seconds since the epoch, defaults to time.time().
+        """
+        with metrics.PHASE_DURATION.labels('actuation').time():
+            actions.set_mode(mode, self.relays)
+        if mode != self.current_mode:
+            metrics.record_mode(self.name, self.current_mode, mode)
+            self.changed_at = time.time() if now is None else now
+        self.current_mode = mode
+
+    def log(self, priority, message, key=None, state=None):
+        """
+        Logs a message about the zone, naming it when there is more than one.
+
+        Parameters:
+        - priority (int): A syslog priority.
+        - message (str): The message.
+        - key (str): What the message reports on, for logs.log(); kept apart from other zones' reports.
+        - state (hashable): The state being reported for the key.
+        """
+        fields = {'zone': self.name} if len(zones) > 1 else {}
+        log(priority, message, key=None if key is None else (key, self.name), state=state, **fields)
+
+    def read_relays(self):
+        """Reads the zone's relays back, as actions.read_relays()."""
+        return actions.read_relays(self.relays)
+
+    def fresh_readings(self, samples, now):
+        """
+        Drops samples older than SENSOR_MAX_AGE and records each reading's age.
+
+        Parameters:
+        - samples (dict): Mapping of metric names to (timestamp, value) tuples, or None where missing.
+        - now (float): Current time in seconds since the epoch.
+
+        Returns:
+        - dict: Mapping of metric names to values, None where missing or stale.
+        """
+        readings = {}
+        for name, sample in samples.items():
+            readings[name] = None
+            if sample is None:
+                # Report how long the reading has been missing, if it was ever seen
+                last_seen = self.store.last_time(name)
+                if last_seen is not None:
+                    metrics.READING_AGE.labels(self.name, name).set(now - last_seen)
+                continue
+            timestamp, value = sample
+            metrics.READING_AGE.labels(self.name, name).set(max(0.0, now - timestamp))
+            if now - timestamp > config.SENSOR_MAX_AGE:
+                self.log(syslog.LOG_WARNING, f"Reading {name} is stale: last sample {now - timestamp:.0f}s old", key=f'stale {name}', state=True)
+                continue
+            readings[name] = value
+        return readings
+
+    def apply_override(self, now=None):
+        """
+        Drives the relays into the operator's cooling mode, if one is set and not yet applied.
+
+        Parameters:
+        - now (float): Current time in seconds since the epoch, defaults to time.time().
+
+        Returns:
+        - dict: The zone's control mode state, as ModeState.snapshot().
+        """
+        state = self.mode_state.snapshot()
+        if state['mode'] != AUTOMATIC and state['cooling'] != self.current_mode:
+            self.set_mode(state['cooling'], now)
+            # The engine picks up from scratch when automatic mode resumes
+            self.engine.reset()
+            self.log(syslog.LOG_INFO, f"Operator override applied: {state['mode']} ({state['cooling']})")
+        return state
+
+    def evaluate(self, readings, now=None):
+        """
+        Evaluate the zone's readings and drive its relays into the appropriate cooling mode.
+
+        Parameters:
+        - readings (dict): The zone's readings, None where missing or stale.
+        - now (float): Current time in seconds since the epoch, defaults to time.time().
+        """
+        if now is None:
+            now = time.time()
+
+        state = self.apply_override(now)
+
+        # Keep the readings even when automatic actions are paused
+        self.store.append(readings, now)
+
+        # Check if we're in automatic mode
+        if state['mode'] != AUTOMATIC:
+            self.log(syslog.LOG_INFO, "In Manual mode; Envirozen automatic actions paused.", key='paused', state=state['cooling'])
+            return
+
+        # Missing or stale readings are handled by the engine's degradation policy
+        missing = [name for name in DECISION_READINGS if readings.get(name) is None]
+        if missing:
+            self.log(syslog.LOG_WARNING, f"Missing temperature readings: {', '.join(missing)}", key='missing', state=tuple(missing))
+
+        decision_start = time.perf_counter()
+
+        # Decide on a mode first, without touching the relays
+        mode, priority, message = self.engine.decide(readings, now)
+        if self.engine.held:
+            metrics.DWELL_HOLDS.labels(self.name, mode).inc()
+        metrics.DEGRADED.labels(self.name).set(1 if self.engine.degraded else 0)
+
+        metrics.PHASE_DURATION.labels('decision').observe(time.perf_counter() - decision_start)
+
+        # Drive the relays into the chosen mode
+        self.set_mode(mode, now)
+        self.log(priority, message, key='decision', state=(mode, self.engine.degraded))
+
+def load_zones():
+    """
+    Builds the zones described by config.ZONES.
+
+    With no ZONES configured there is one zone, named DEFAULT_ZONE, made from
+    QUERIES, METRIC_THRESHOLDS and GPIO_PINS and sharing the module-level
+    relays, readings store and mode state, so single-room setups behave
+    exactly as before. Every zone's relays share one GPIO backend.
+
+    Returns:
+    - list: The zones, in configuration order.
+    """
+    if not config.ZONES:
+        return [Zone(DEFAULT_ZONE, config.QUERIES, None, actions.relays, readings_store, mode_state)]
+
+    zones = []
+    for name, spec in config.ZONES.items():
+        queries = spec['queries']
+        zones.append(Zone(
+            name,
+            queries,
+            dict(config.METRIC_THRESHOLDS, **spec.get('thresholds', {})),
+            actions.RelayBank(actions.backend, spec['gpio_pins'], zone=name),
+            TimeSeriesStore(queries, config.SERIES_RETENTION, config.evaluation_interval),
+            ModeState(spec.get('mode_state_file', os.path.join(os.path.dirname(config.MODE_STATE_FILE), f'mode-{name}.json'))),
+        ))
+    return zones
+
+def reconfigure_zones():
+    """Applies reloaded queries and thresholds to every zone, keeping their state."""
+    if not config.ZONES:
+        zones[0].reconfigure(config.QUERIES, None)
+        return
+    for zone in zones:
+        spec = config.ZONES[zone.name]
+        zone.reconfigure(spec['queries'], dict(config.METRIC_THRESHOLDS, **spec.get('thresholds', {})))
+
+def get_zone(name=None):
+    """
+    Looks up a zone by name.
+
+    Parameters:
+    - name (str): The zone's name, or None for the first zone.
+
+    Raises:
+    - KeyError: If there is no such zone.
+    """
+    if name is None:
+        return zones[0]
+    for zone in zones:
+        if zone.name == name:
+            return zone
+    raise KeyError(f"Unknown zone '{name}'")
+
+# Every zone this controller drives
+zones = load_zones()
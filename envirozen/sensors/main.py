@@ -1,21 +1,44 @@
+import gc
 import network
-import socket
+import ntptime
 import time
 import machine
+import uasyncio
 import sensor_readings
-  
+
+from array import array
+
 from machine import Pin
- 
+
 intled = machine.Pin("LED", machine.Pin.OUT)
-  
+
 ssid = '**ZSENPOD**'
 password = 'allchildrenexceptonegrowup'
- 
+
 # Board location, this will be used in the Prometheus metrics to identify the sensor
 # it can be a location or a name
 location = 'external'
 hostname = 'Envirozen_' + location
 
+# The sensors are read on a timer and /metrics is served from the last reading,
+# so a scrape never waits on the BH1745's integration time, and only waits on the
+# BME688 if it arrives during that sensor's measurement
+sample_interval = 5  # Seconds between sensor readings
+max_reading_age = 60  # Seconds after which a reading is too old to serve
+client_timeout = 5  # Seconds a client has to send its request
+max_clients = 4  # Connections queued while others are being answered
+request_size = 256  # Bytes of each request kept; the rest of a long request is read and dropped
+value_width = 12  # Characters reserved for each value in the response
+
+# Readings are also kept in a ring buffer and pushed to the controller in batches,
+# so readings taken while Wi-Fi or the controller is down fill the gap once it is back
+ingest_url = None  # e.g. 'http://192.168.88.88:5000/api/ingest', None to only serve /metrics
+history_size = 720  # Readings kept, an hour at the default sample_interval
+push_interval = 60  # Seconds between pushes while connected
+push_batch = 60  # Readings sent per request
+push_timeout = 30  # Seconds allowed for a whole push
+reconnect_interval = 10  # Seconds between Wi-Fi checks
+
 wlan = network.WLAN(network.STA_IF)
 wlan.active(True)
 wlan.connect(ssid, password)
@@ -23,7 +46,7 @@ wlan.connect(ssid, password)
 # Set the hostname
 # machine.set_hostname(hostname) # Not supported in MicroPython
 
-# This will be replaced with the actual metric values
+# The values are written into their slots in the response after each reading
 metrics_template = """
 # HELP Temperature recorded in celcius
 # TYPE temperature gauge
@@ -45,6 +68,60 @@ luminance{{location="{location}"}} {luminance}
 # TYPE color_temperature gauge
 color_temperature{{location="{location}"}} {color_temperature}
 """
+
+# Metrics in the order they appear in the template, with their decimal places
+fields = (
+    ("temperature", 2),
+    ("humidity", 2),
+    ("pressure", 2),
+    ("luminance", 0),
+    ("color_temperature", 0),
+)
+
+# The whole /metrics response lives in one buffer that is built once and then
+# only has its values overwritten, so answering a scrape formats, encodes and
+# allocates nothing; each value is right-aligned in a fixed-width slot
+# (Prometheus ignores the extra spaces before it)
+body = metrics_template.format(location=location, **{name: '#' * value_width for name, _ in fields})
+body = 'HTTP/1.0 200 OK\r\nContent-type: text/plain\r\nContent-length: %d\r\n\r\n%s' % (len(body), body)
+slot_ends = []
+for name, _ in fields:
+    slot_ends.append(body.find('#' * value_width, slot_ends[-1] if slot_ends else 0) + value_width)
+response = bytearray(body.encode())
+del body
+
+not_found = b'HTTP/1.0 404 Not Found\r\nContent-type: text/plain\r\n\r\nNot Found'
+unavailable = b'HTTP/1.0 503 Service Unavailable\r\nContent-type: text/plain\r\n\r\nNo recent reading'
+metrics_request = b'GET /metrics '
+end_of_headers = b'\r\n\r\n'
+
+# Buffers requests are read into, reused from one client to the next
+request_buffers = [bytearray(request_size) for _ in range(max_clients)]
+
+# When the last reading was taken, None until the first one
+sampled_at = None
+
+# Ring buffer of readings not yet pushed: when each was taken (ticks_ms) and its values, in field order
+history_ticks = array('i', [0] * history_size)
+history_values = array('f', [0] * (history_size * len(fields)))
+# Readings are numbered in the order they are taken and reading n goes in slot n % history_size,
+# so a reading overwritten while a push is in flight is simply skipped rather than shifting the rest
+history_total = 0  # Readings taken so far, and so the number of the next one
+history_sent = 0  # Number of the first reading not yet pushed
+pushing = False
+
+# One line per value, with the timestamp in milliseconds that the controller needs to place it
+push_formats = ['%s{location="%s"} %%.%df %%d\n' % (name, location, decimals) for name, decimals in fields]
+if ingest_url is not None:
+    ingest_host, _, ingest_path = ingest_url[len('http://'):].partition('/')
+    ingest_host, _, ingest_port = ingest_host.partition(':')
+    ingest_port = int(ingest_port or 80)
+    ingest_path = '/' + ingest_path
+
+# Seconds between the Unix epoch and the board's, which is 2000 on some ports
+epoch_offset = 946684800 if time.gmtime(0)[0] == 2000 else 0
+clock_synced = False
+
 def initialize_connection():
     # Wait for connect or fail
     max_wait = 10
@@ -62,69 +139,251 @@ def initialize_connection():
         print('connected')
         status = wlan.ifconfig()
         print( 'ip = ' + status[0] )
-    
-    # Open socket
-    addr = socket.getaddrinfo('0.0.0.0', 80)[0][-1]
-    
-    s = socket.socket()
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(addr)
-    s.listen(1)
-
-    print('listening on', addr)
-    return s
-
-stateis = ""
- 
-def main_loop(s):
-    # Listen for connections
-    while True:
+        sync_clock()
+
+def sync_clock():
+    # Pushed readings need real timestamps, so set the clock from NTP after each connect
+    global clock_synced
+    try:
+        ntptime.settime()
+        clock_synced = True
+    except Exception as e:
+        print('clock sync failed:', e)
+
+def write_number(buf, end, value, decimals):
+    # Writes value right-aligned into the value_width bytes before end, padding with spaces
+    start = end - value_width
+    if value != value or abs(value) >= 10 ** (value_width - decimals - 2):
+        # NaN or too wide for the slot
+        buf[end - 3:end] = b'NaN'
+        end -= 3
+    else:
+        digits = int(abs(value) * 10 ** decimals + 0.5)
+        for _ in range(decimals):
+            end -= 1
+            buf[end] = 48 + digits % 10
+            digits //= 10
+        if decimals:
+            end -= 1
+            buf[end] = 46  # '.'
+        while True:
+            end -= 1
+            buf[end] = 48 + digits % 10
+            digits //= 10
+            if not digits:
+                break
+        if value < 0:
+            end -= 1
+            buf[end] = 45  # '-'
+    while end > start:
+        end -= 1
+        buf[end] = 32  # ' '
+
+async def sample():
+    # Read the sensors and write the values into the response, for every scrape until the next reading.
+    # The BH1745 integrates while the BME688 is read, and the loop is free for scrapes and pushes
+    # between the reads and for whatever is left of the integration time
+    global sampled_at
+    sensor_readings.start_light_reading()
+    started = time.ticks_ms()
+    await uasyncio.sleep_ms(0)
+    readings = sensor_readings.get_climate_readings()
+    remaining = sensor_readings.LIGHT_INTEGRATION_MS - time.ticks_diff(time.ticks_ms(), started)
+    await uasyncio.sleep_ms(max(0, remaining))
+    readings.update(sensor_readings.get_light_readings())
+
+    for (name, decimals), end in zip(fields, slot_ends):
+        write_number(response, end, readings[name], decimals)
+    sampled_at = time.ticks_ms()
+    record(readings)
+
+def record(readings):
+    # Add the reading to the ring buffer, overwriting the oldest if it is full
+    global history_total
+    slot = history_total % history_size
+    history_ticks[slot] = sampled_at
+    base = slot * len(fields)
+    for i in range(len(fields)):
+        history_values[base + i] = readings[fields[i][0]]
+    history_total += 1
+
+async def post(body):
+    # Send one batch to the controller and return the response's status code
+    reader, writer = await uasyncio.open_connection(ingest_host, ingest_port)
+    try:
+        writer.write(('POST %s HTTP/1.0\r\nHost: %s\r\nContent-type: text/plain\r\nContent-length: %d\r\n\r\n'
+                      % (ingest_path, ingest_host, len(body))).encode())
+        writer.write(body)
+        await writer.drain()
+        status_line = await reader.readline()
+    finally:
+        writer.close()
         try:
-            cl, addr = s.accept()
-            print('client connected from', addr)
+            await writer.wait_closed()
+        except OSError:
+            pass
+    return int(status_line.split(b' ')[1])
 
-            request = cl.recv(1024)
-            print(request)
+async def push_history():
+    # Push the buffered readings, oldest first, push_batch at a time
+    global history_sent
+    now_ticks = time.ticks_ms()
+    now_ms = (time.time() + epoch_offset) * 1000
+    while True:
+        # Readings older than the last history_size have been overwritten
+        first = max(history_sent, history_total - history_size)
+        count = min(history_total - first, push_batch)
+        if not count:
+            return
+        lines = []
+        for n in range(count):
+            slot = (first + n) % history_size
+            timestamp = now_ms - time.ticks_diff(now_ticks, history_ticks[slot])
+            for i in range(len(fields)):
+                lines.append(push_formats[i] % (history_values[slot * len(fields) + i], timestamp))
+        body = ''.join(lines).encode()
+        del lines
+        status = await post(body)
+        del body
+        if status >= 500:
+            # The controller can't take them now; keep them for the next push
+            print('push rejected:', status)
+            return
+        if status >= 300:
+            # A batch the controller refuses will never be accepted, so drop it rather than retry forever
+            print('push rejected:', status)
+        history_sent = first + count
+
+async def push():
+    global pushing
+    if ingest_url is None or history_sent == history_total or pushing:
+        return
+    if not clock_synced:
+        sync_clock()
+        if not clock_synced:
+            return
+    pushing = True
+    try:
+        await uasyncio.wait_for(push_history(), push_timeout)
+    except (OSError, ValueError, IndexError, uasyncio.TimeoutError) as e:
+        print('push failed:', e)
+    finally:
+        pushing = False
+        gc.collect()
 
-            # Split the request into lines
-            request_lines = request.split(b'\r\n')
+async def push_loop():
+    while True:
+        await uasyncio.sleep(push_interval)
+        if wlan.isconnected():
+            await push()
 
-            # Extract the request method and path from the first line
-            # Typical first line: 'GET /metrics HTTP/1.1'
-            method, path, _ = request_lines[0].split(b' ', 2)
+async def network_loop():
+    # Reconnect when Wi-Fi drops instead of resetting, so the buffered readings survive,
+    # and push them as soon as it is back
+    while True:
+        await uasyncio.sleep(reconnect_interval)
+        if wlan.isconnected():
+            continue
+        print('Wi-Fi lost, reconnecting...')
+        wlan.connect(ssid, password)
+        for _ in range(10):
+            await uasyncio.sleep(1)
+            if wlan.isconnected():
+                break
+        else:
+            continue
+        print('reconnected')
+        sync_clock()
+        await push()
 
-            if method == b'GET' and path == b'/metrics':
-                # Handle the metric response here
+async def sample_loop():
+    while True:
+        await uasyncio.sleep(sample_interval)
+        try:
+            await sample()
+        except Exception as e:
+            # Keep serving the last reading until it is too old
+            print('sensor read failed:', e)
+        # Collect garbage now, between scrapes, rather than in the middle of one
+        gc.collect()
 
-                readings = sensor_readings.get_sensor_readings()
+def starts_with(buf, length, prefix):
+    # Compares the start of buf with prefix without slicing a copy
+    if length < len(prefix):
+        return False
+    for i in range(len(prefix)):
+        if buf[i] != prefix[i]:
+            return False
+    return True
 
-                response = metrics_template.format(
-                    location=location,
-                    temperature=readings["temperature"],
-                    humidity=readings["humidity"],
-                    pressure=readings["pressure"],
-                    luminance=readings["luminance"],
-                    color_temperature=readings["color_temperature"]
-                )
+async def read_request(reader, buf):
+    # Reads a request until the blank line ending its headers, returning how many bytes of buf it filled;
+    # anything beyond the buffer is read over its last 64 bytes, so buf always starts with the request line
+    view = memoryview(buf)
+    length = 0
+    matched = 0  # Bytes of end_of_headers seen so far
+    while matched < 4:
+        offset = length if length < len(buf) else len(buf) - 64
+        count = await reader.readinto(view[offset:])
+        if not count:
+            break
+        for i in range(offset, offset + count):
+            if buf[i] == end_of_headers[matched]:
+                matched += 1
+                if matched == 4:
+                    break
+            else:
+                matched = 1 if buf[i] == 13 else 0
+        length = max(length, offset + count)
+    return length
 
+async def handle_client(reader, writer):
+    buf = request_buffers.pop() if request_buffers else bytearray(request_size)
+    try:
+        length = await uasyncio.wait_for(read_request(reader, buf), client_timeout)
 
-                cl.send(b'HTTP/1.0 200 OK\r\nContent-type: text/plain\r\n\r\n')
-                cl.send(response.encode())
+        # Typical first line: 'GET /metrics HTTP/1.1'
+        if starts_with(buf, length, metrics_request):
+            if sampled_at is not None and time.ticks_diff(time.ticks_ms(), sampled_at) < max_reading_age * 1000:
+                writer.write(response)
             else:
-                # You can send an error message or some other response here if needed.
-                cl.send(b'HTTP/1.0 404 Not Found\r\nContent-type: text/plain\r\n\r\nNot Found')
+                # Let Prometheus see the sensor as down rather than scrape a frozen reading
+                writer.write(unavailable)
+        else:
+            # You can send an error message or some other response here if needed.
+            writer.write(not_found)
+        await writer.drain()
+
+    except (OSError, uasyncio.TimeoutError) as e:
+        print('connection closed:', e)
+
+    finally:
+        if len(request_buffers) < max_clients:
+            request_buffers.append(buf)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+async def main():
+    initialize_connection()
+
+    # Have a reading ready before the first scrape can arrive
+    await sample()
+    uasyncio.create_task(sample_loop())
+    uasyncio.create_task(network_loop())
+    uasyncio.create_task(push_loop())
 
-            cl.close()
-    
-        except OSError as e:
-            cl.close()
-            print('connection closed')
+    # Each client is handled in its own task, so concurrent scrapes don't queue behind each other
+    server = await uasyncio.start_server(handle_client, '0.0.0.0', 80, backlog=max_clients)
+    print('listening on port 80')
+    await server.wait_closed()
 
 # Main execution
 try:
-    s = initialize_connection()
-    main_loop(s)
+    uasyncio.run(main())
 except Exception as e:
     print('Critical error encountered:', e)
     print('Rebooting...')
-    machine.reset()
\ No newline at end of file
+    machine.reset()
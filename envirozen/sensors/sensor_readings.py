@@ -162,6 +162,9 @@ bh1745 = BreakoutBH1745(i2c)
 # reports bad results (this is undocumented...)
 i2c.writeto_mem(0x38, 0x44, b'\x02')
 
+# how long the bh1745 integrates light for each reading
+LIGHT_INTEGRATION_MS = 160
+
 def sensors():
   return [
     "temperature",
@@ -179,7 +182,7 @@ def lux_from_rgbc(r, g, b, c):
   else:
       tmp = 0.159 * r + 0.646 * g
   tmp = 0 if tmp < 0 else tmp
-  integration_time = 160
+  integration_time = LIGHT_INTEGRATION_MS
   gain = 1
   return round(tmp / gain / integration_time * 160)
 
@@ -200,16 +203,32 @@ def colour_temperature_from_rgbc(r, g, b, c):
       ct = 10000
   return round(ct)
 
-def get_sensor_readings():
-  data = bme688.read()
-  bh1745.measurement_time_ms(160)
+def start_light_reading():
+  # restart the bh1745's measurement; its result is ready LIGHT_INTEGRATION_MS later,
+  # and get_light_readings() waits for it if called any sooner
+  bh1745.measurement_time_ms(LIGHT_INTEGRATION_MS)
 
+def get_light_readings():
   r, g, b, c = bh1745.rgbc_raw()
 
   return {
-    "temperature": round(data[0], 2),
-    "humidity": round(data[2], 2),
-    "pressure": round(data[1] / 100.0, 2),
     "luminance": lux_from_rgbc(r, g, b, c),
     "color_temperature": colour_temperature_from_rgbc(r, g, b, c)
   }
+
+def get_climate_readings():
+  # the bme688 takes a forced measurement, which blocks until it completes
+  data = bme688.read()
+
+  return {
+    "temperature": round(data[0], 2),
+    "humidity": round(data[2], 2),
+    "pressure": round(data[1] / 100.0, 2)
+  }
+
+def get_sensor_readings():
+  # every reading at once, blocking for the light sensor's integration time
+  start_light_reading()
+  readings = get_climate_readings()
+  readings.update(get_light_readings())
+  return readings
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The controller's modules import each other by name, as when run from its directory
+CONTROLLER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'controller')
+sys.path.insert(0, CONTROLLER_DIR)
+
+import config
+
+# Keep the relays in memory, so the tests run without a Pi
+config.GPIO_BACKEND = 'fake'
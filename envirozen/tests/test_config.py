@@ -0,0 +1,35 @@
+import os
+import runpy
+from conftest import CONTROLLER_DIR
+from reloader import validate
+
+EXAMPLE = os.path.join(CONTROLLER_DIR, 'config.py.example')
+
+def example_zones():
+    """Returns the ZONES example that config.py.example shows commented out."""
+    lines = []
+    with open(EXAMPLE) as file:
+        for line in file:
+            if line.startswith('# ZONES = {'):
+                lines.append(line[2:])
+            elif lines:
+                lines.append(line[2:])
+                if line.startswith('# }'):
+                    break
+    namespace = {}
+    exec(''.join(lines), namespace)
+    return namespace['ZONES']
+
+def test_example_config_is_valid():
+    """The example config must start a controller as shipped."""
+    assert validate(runpy.run_path(EXAMPLE)) == []
+
+def test_example_zones_are_valid():
+    """The commented-out ZONES example must start a controller once uncommented."""
+    settings = runpy.run_path(EXAMPLE)
+    settings['ZONES'] = example_zones()
+    assert len(settings['ZONES']) == 2
+    assert validate(settings) == []
+
+def test_config_is_valid():
+    assert validate(runpy.run_path(os.path.join(CONTROLLER_DIR, 'config.py'))) == []
@@ -0,0 +1,126 @@
+import pytest
+from decision import MODE_CODES, DecisionEngine, choose_mode
+from store import TimeSeriesStore
+
+QUERIES = {
+    'temperature_ambient': 'temperature{location="ambient"}',
+    'temperature_cold': 'temperature{location="cold"}',
+    'temperature_hot': 'temperature{location="hot"}',
+}
+THRESHOLDS = {
+    'temperature_ambient': 25,
+    'temperature_cold_min': 10,
+    'temperature_cold': 20,
+    'temperature_cold_warning': 25,
+    'temperature_hot': 31,
+    'temperature_emergency': 36,
+}
+SETTINGS = {
+    'hysteresis': {'temperature_cold': 1.0, 'temperature_cold_min': 1.0, 'temperature_hot': 1.0},
+    'min_dwell': {'freecooling_turbo': 600, 'ac': 900},
+    'trend_window': 300,
+    'lookahead': 300,
+    'hot_aisle_offset': 10,
+    'hot_aisle_emergency_after': 900,
+}
+
+def make_engine(**settings):
+    store = TimeSeriesStore(QUERIES, 3600, 10)
+    return DecisionEngine(store, THRESHOLDS, **dict(SETTINGS, **settings))
+
+def decide(engine, now, ambient=10.0, cold=15.0, hot=25.0):
+    """Appends a tick's readings to the engine's store and decides on them, as Zone.evaluate() does."""
+    readings = {'temperature_ambient': ambient, 'temperature_cold': cold, 'temperature_hot': hot}
+    engine.store.append(readings, now)
+    return engine.decide(readings, now)[0]
+
+@pytest.mark.parametrize('lookahead, expected', [(300, 'ac'), (0, 'freecooling')])
+def test_steps_up_on_a_projected_crossing(lookahead, expected):
+    engine = make_engine(lookahead=lookahead)
+    # The hot aisle climbs 0.1°C every 10s tick, so it is projected 3°C higher 300s ahead
+    for tick in range(31):
+        hot = 26.0 + 0.1 * tick
+        mode = decide(engine, 1000.0 + 10 * tick, hot=hot)
+    assert hot < THRESHOLDS['temperature_hot']
+    assert choose_mode(10.0, 15.0, hot, THRESHOLDS)[0] == 'freecooling'
+    assert mode == expected
+
+def test_steps_down_only_below_the_hysteresis_band_after_the_dwell():
+    engine = make_engine(lookahead=0)
+    assert decide(engine, 0.0, cold=22.0) == 'freecooling_turbo'
+
+    # Just below the threshold but inside its band: stays, however long it waits
+    assert decide(engine, 10.0, cold=19.5) == 'freecooling_turbo'
+    assert decide(engine, 1000.0, cold=19.5) == 'freecooling_turbo'
+    assert not engine.held
+
+    # Below the band but before the dwell has run out: held
+    engine = make_engine(lookahead=0)
+    decide(engine, 0.0, cold=22.0)
+    assert decide(engine, 100.0, cold=18.5) == 'freecooling_turbo'
+    assert engine.held
+
+    # Once the dwell has run out it steps down
+    assert decide(engine, 600.0, cold=18.5) == 'freecooling'
+    assert engine.since == 600.0
+
+def test_steps_up_straight_away_despite_the_dwell():
+    engine = make_engine(lookahead=0)
+    decide(engine, 0.0, cold=15.0)
+    assert decide(engine, 10.0, cold=22.0) == 'freecooling_turbo'
+    assert decide(engine, 20.0, hot=37.0) == 'emergency'
+
+def test_estimates_the_hot_aisle_from_the_cold_aisle():
+    engine = make_engine()
+    # 32°C estimated from a 22°C cold aisle is above the hot threshold
+    assert decide(engine, 0.0, cold=22.0, hot=None) == 'ac'
+    assert engine.degraded
+
+    readings, minimum, reasons = engine.degrade({'temperature_ambient': 10.0, 'temperature_cold': 22.0, 'temperature_hot': None}, 10.0)
+    assert readings == [10.0, 22.0, 22.0 + SETTINGS['hot_aisle_offset']]
+    assert minimum is None and reasons
+
+def test_estimates_the_cold_aisle_from_the_hot_aisle():
+    engine = make_engine()
+    assert decide(engine, 0.0, cold=None, hot=28.0) == 'freecooling'
+    assert engine.degraded
+
+def test_escalates_to_emergency_once_the_hot_aisle_has_been_missing_long_enough():
+    engine = make_engine(lookahead=0)
+    assert decide(engine, 0.0, hot=25.0) == 'freecooling'
+
+    # Estimated from the cold aisle until hot_aisle_emergency_after has passed since it was last seen
+    assert decide(engine, 600.0, hot=None) == 'freecooling'
+    assert decide(engine, 899.0, hot=None) == 'freecooling'
+    assert decide(engine, 900.0, hot=None) == 'emergency'
+
+    # Emergency has no dwell here, so it steps straight back down once the reading is back
+    assert decide(engine, 910.0, hot=25.0) == 'freecooling'
+
+def test_without_any_aisle_reading_runs_at_least_ac():
+    engine = make_engine()
+    assert decide(engine, 0.0, cold=None, hot=None) == 'ac'
+    assert decide(engine, 10.0, ambient=None) == 'ac'
+
+def test_replay_matches_the_stateful_engine():
+    np = pytest.importorskip('numpy')
+    import replay
+
+    rng = np.random.default_rng(3)
+    count = 5000
+    timestamps = 1.7e9 + 10.0 * np.arange(count)
+    # Slow random walks around the thresholds, with noise, isolated dropouts and longer outages
+    walk = lambda mean: mean + np.cumsum(rng.normal(0, 0.05, count)) + rng.normal(0, 0.1, count)
+    series = {'temperature_ambient': walk(20.0), 'temperature_cold': walk(20.0), 'temperature_hot': walk(30.0)}
+    for values in series.values():
+        values[rng.random(count) < 0.02] = np.nan
+        for start in rng.integers(0, count - 200, 5):
+            values[start:start + rng.integers(10, 200)] = np.nan
+
+    modes, _ = replay.replay(timestamps, series, make_engine())
+
+    engine = make_engine()
+    for index, now in enumerate(timestamps):
+        readings = {name: None if np.isnan(values[index]) else float(values[index]) for name, values in series.items()}
+        assert decide(engine, float(now), *(readings[name] for name in QUERIES)) == MODE_CODES[modes[index]], f"sample {index}"
+    assert len(set(modes.tolist())) > 2
@@ -0,0 +1,33 @@
+import json
+import pytest
+from mode import ModeState, AUTOMATIC, MANUAL, EMERGENCY
+
+def test_state_survives_a_reload(tmp_path):
+    path = str(tmp_path / 'mode.json')
+    ModeState(path).set(MANUAL, 'freecooling')
+
+    state = ModeState(path)
+    state.load()
+    assert state.snapshot() == {'mode': MANUAL, 'cooling': 'freecooling'}
+
+def test_missing_file_keeps_the_current_state(tmp_path):
+    state = ModeState(str(tmp_path / 'mode.json'))
+    state.load()
+    assert state.snapshot() == {'mode': AUTOMATIC, 'cooling': None}
+
+@pytest.mark.parametrize('data', [
+    [],
+    {},
+    {'mode': MANUAL},
+    {'mode': MANUAL, 'cooling': 'turbo'},
+    {'mode': 'off', 'cooling': None},
+    'manual',
+])
+def test_unusable_file_falls_back_to_automatic(tmp_path, data):
+    path = tmp_path / 'mode.json'
+    path.write_text(json.dumps(data))
+
+    state = ModeState(str(path))
+    state.control, state.cooling = EMERGENCY, 'emergency'
+    state.load()
+    assert state.snapshot() == {'mode': AUTOMATIC, 'cooling': None}
@@ -0,0 +1,76 @@
+import random
+import pytest
+from store import SeriesBuffer, TimeSeriesStore
+
+QUERIES = {'temperature_cold': 'temperature{location="cold"}', 'temperature_cold_min': 'temperature{location="cold"}'}
+WINDOW = 300
+
+def in_window(samples, now, length):
+    return [(timestamp, value) for timestamp, value in samples if timestamp > now - length]
+
+def brute_slope(samples, now, length):
+    """TimeSeriesStore.slope() worked out from scratch over the stored samples."""
+    newer = in_window(samples, now, length / 2)
+    older = [sample for sample in in_window(samples, now, length) if sample not in newer]
+    if not older or not newer:
+        return 0.0
+    mean = lambda points, index: sum(point[index] for point in points) / len(points)
+    return (mean(newer, 1) - mean(older, 1)) / (mean(newer, 0) - mean(older, 0))
+
+def check_against_brute_force(store, samples):
+    # Windows end at the newest sample, which a missing reading does not move
+    now = samples[-1][0]
+    for length in (WINDOW, WINDOW / 2):
+        window = in_window(samples, now, length)
+        values = [value for _, value in window]
+        assert store.minimum('temperature_cold', length) == (min(values) if values else None)
+        assert store.maximum('temperature_cold', length) == (max(values) if values else None)
+        assert store.mean('temperature_cold', length) == (pytest.approx(sum(values) / len(values)) if values else None)
+    assert store.slope('temperature_cold', WINDOW) == pytest.approx(brute_slope(samples, now, WINDOW), rel=1e-6, abs=1e-12)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rolling_statistics_match_brute_force(seed):
+    rng = random.Random(seed)
+    store = TimeSeriesStore(QUERIES, 600, 10)
+    store.track(WINDOW)
+    store.track(WINDOW / 2)
+
+    now = 1.7e9
+    for _ in range(500):
+        # Irregular spacing and the odd missing reading, as the control loop sees
+        now += rng.choice((5, 10, 10, 10, 25, 70))
+        value = None if rng.random() < 0.05 else rng.uniform(15, 30)
+        store.append({'temperature_cold': value}, now)
+        if len(store.buffers['temperature_cold']):
+            check_against_brute_force(store, store.buffers['temperature_cold'].samples())
+
+def test_shared_query_is_stored_once():
+    store = TimeSeriesStore(QUERIES, 600, 10)
+    store.append({'temperature_cold': 20.0, 'temperature_cold_min': 20.0}, 1.0)
+    assert store.buffers['temperature_cold'] is store.buffers['temperature_cold_min']
+    assert len(store.buffers['temperature_cold']) == 1
+
+def test_window_tracked_late_is_filled_from_stored_samples():
+    rng = random.Random(7)
+    store = TimeSeriesStore(QUERIES, 3600, 10)
+    now = 1.7e9
+    for _ in range(100):
+        now += 10
+        store.append({'temperature_cold': rng.uniform(15, 30)}, now)
+
+    # As after a warm restore: the windows are registered once the samples are already stored
+    store.track(WINDOW)
+    store.track(WINDOW / 2)
+    check_against_brute_force(store, store.buffers['temperature_cold'].samples())
+
+    now += 10
+    store.append({'temperature_cold': 22.0}, now)
+    check_against_brute_force(store, store.buffers['temperature_cold'].samples())
+
+def test_full_buffer_overwrites_the_oldest_sample():
+    buffer = SeriesBuffer(3)
+    window = buffer.track(1000)
+    for timestamp in range(5):
+        buffer.append(float(timestamp), float(timestamp))
+    assert buffer.samples() == [(2.0, 2.0), (3.0, 3.0), (4.0, 4.0)]
+    assert (window.count, window.minimum(), window.maximum()) == (3, 2.0, 4.0)